@@ -8,20 +8,36 @@ from fastapi import FastAPI
 from api.routers.auth import router as auth_router
 from api.routers.port import router as v1_router
 from api.routers.info import info_router
-from api.utils.tasks import waiting_requests_check, handle_expired_port_rents, synchronize_ports
+from api.utils.http_client import http_clients
+from api.utils.tasks import serve_waiting_requests, handle_deadline, synchronize_ports
+from database.deadlines import deadlines
+from database.dimensions import dimensions
+from database.migrations import migrate
+from database.port_index import free_ports
+from database.waiting_queue import waiting_queue
 
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    await migrate()
+    await http_clients.start()
+    await dimensions.rebuild()
+    await free_ports.rebuild()
+    await waiting_queue.rebuild()
+    await deadlines.rebuild()
+    waiting_task = asyncio.create_task(serve_waiting_requests())
+    deadlines_task = asyncio.create_task(deadlines.run(handle_deadline))
+
     scheduler = AsyncIOScheduler()
-    scheduler.add_job(waiting_requests_check, "interval", seconds=5)
-    scheduler.add_job(handle_expired_port_rents, "interval", seconds=10)
     scheduler.add_job(synchronize_ports, "interval", minutes=30)
     scheduler.start()
     yield
 
     scheduler.shutdown()
+    waiting_task.cancel()
+    deadlines_task.cancel()
+    await http_clients.close()
 
 
 app = FastAPI(lifespan=lifespan)
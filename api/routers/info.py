@@ -1,7 +1,8 @@
 from fastapi import APIRouter, Depends
 
 from database.operations.bot_operations import get_geos as get_geos_db
-from api.schemas.info import GeosResponse
+from api.schemas.info import GeosResponse, RotationStatsResponse
+from api.utils.rotation import rotation_pool
 
 info_router = APIRouter()
 
@@ -12,3 +13,8 @@ async def get_geos():
     return GeosResponse(available_geos=geo_names)
 
 
+
+
+@info_router.get("/rotation", response_model=RotationStatsResponse)
+async def get_rotation_stats():
+    return RotationStatsResponse(**rotation_pool.stats())
@@ -1,13 +1,15 @@
 from fastapi import APIRouter, Depends, BackgroundTasks
 
 from api.core.security import get_current_user
-from database.session import get_db, SessionLocal
-from api.schemas.port import PortRequest, PortResponse, ErrorResponse, SuccessResponse, PortData
-from database.operations.api_port_transactions import (write_request, is_waiting_for_port, set_waiting_for_port, allocate_port,
-                                                       is_same_request, give_port_if_found, check_response_existence, check_rent_already_ended,
-                                                       )
+from database.session import get_db
+from api.schemas.port import (PortRequest, PortsRequest, PortResponse, PortsResponse, OrderedPort, ErrorResponse,
+                              SuccessResponse, PortData)
+from database.operations.api_port_transactions import (AllocationResult, request_port, request_ports,
+                                                       check_response_existence, check_rent_already_ended)
 
 from api.utils.tasks import end_proxy_port_rent
+from database.enums import RequestStatus
+from database.waiting_queue import waiting_queue
 
 router = APIRouter()
 
@@ -15,6 +17,21 @@ router = APIRouter()
 # get_current_user = lambda: "user1"
 
 
+def _port_data(result: AllocationResult) -> PortData:
+    port, ip_info = result.port, result.ip_info
+    return PortData(
+        host=port.host,
+        socks_port=port.socks_port,
+        http_port=port.http_port,
+        login=port.login,
+        password=port.password,
+        end_timestamp_utc=result.end_timestamp_utc,
+        ip=ip_info.ip,
+        city=ip_info.city.city if ip_info.city else None,
+        operator=ip_info.operator.operator if ip_info.operator else None
+    )
+
+
 # TODO define possible responses and codes inside get()
 @router.get("/getport")
 async def get_proxy_port(
@@ -22,43 +39,32 @@ async def get_proxy_port(
         current_user=Depends(get_current_user),
         db=Depends(get_db)
 ):
+    result = await request_port(db, port_request, current_user.login)
+
+    # Long polling: hold the request until the waiting queue puts a port on hold for it, then pick it up
+    if not result.success and port_request.wait and result.request_status == RequestStatus.WAITING_FOR_PORT:
+        if await waiting_queue.wait_until_served(result.request_id, port_request.wait):
+            result = await request_port(db, port_request, current_user.login)
+
+    if result.success:
+        return PortResponse(order_id=result.response_id, data=_port_data(result))
+
+    return ErrorResponse(success=False, error="No port is available for this request. Please try again later.")
+
+
+@router.get("/getports")
+async def get_proxy_ports(
+        ports_request: PortsRequest = Depends(),
+        current_user=Depends(get_current_user),
+        db=Depends(get_db)
+):
+    results = await request_ports(db, ports_request, ports_request.count, current_user.login)
+
+    if not results:
+        return ErrorResponse(success=False, error="No port is available for this request. Please try again later.")
 
-    same_request_id = await is_same_request(port_request, current_user)         # current_user.login
-    if same_request_id:
-        port, end_time, response_id = await give_port_if_found(db, same_request_id, port_request.rent_time)
-        if port:
-            return PortResponse(order_id=response_id,
-                                data=PortData(
-                                    host=port.host,
-                                    socks_port=port.socks_port,
-                                    http_port=port.http_port,
-                                    login=port.login,
-                                    password=port.password,
-                                    end_timestamp_utc=end_time
-                                ))
-        else:
-            return ErrorResponse(success=False, error="No port is available for this request. Please try again later.")
-
-    else:
-        request_id = await write_request(db, port_request, current_user)    # current_user.login
-        port, end_time, response_id = await allocate_port(db, port_request, request_id)
-
-        if port:
-            return PortResponse(order_id=response_id,
-                                data=PortData(
-                                    host=port.host,
-                                    socks_port=port.socks_port,
-                                    http_port=port.http_port,
-                                    login=port.login,
-                                    password=port.password,
-                                    end_timestamp_utc=end_time
-                                ))
-        else:
-            waiting_for_port = await is_waiting_for_port(db, current_user, port_request)
-            if not waiting_for_port:
-                await set_waiting_for_port(db, request_id)
-
-            return ErrorResponse(success=False, error="No port is available for this request. Please try again later.")
+    return PortsResponse(requested=ports_request.count,
+                         ports=[OrderedPort(order_id=result.response_id, data=_port_data(result)) for result in results])
 
 
 # TODO define possible responses and codes inside get()
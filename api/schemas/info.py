@@ -2,3 +2,15 @@ from pydantic import BaseModel
 
 class GeosResponse(BaseModel):
     available_geos: list[str]
+
+
+class StageTimingData(BaseModel):
+    count: int
+    average: float
+    max: float
+
+
+class RotationStatsResponse(BaseModel):
+    queued: int
+    running: int
+    stages: dict[str, StageTimingData]
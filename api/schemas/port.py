@@ -3,7 +3,7 @@ from datetime import datetime
 from pydantic import BaseModel, field_validator
 
 
-class PortRequest(BaseModel):
+class BasePortRequest(BaseModel):
     servername: str
     priority: int
     geo: str
@@ -34,6 +34,28 @@ class PortRequest(BaseModel):
         return v
 
 
+class PortRequest(BasePortRequest):
+    wait: int = 0
+
+    @field_validator('wait')
+    @classmethod
+    def validate_wait(cls, v):
+        if v < 0 or v > 60:
+            raise ValueError('Wait must be in range 0-60 seconds')
+        return v
+
+
+class PortsRequest(BasePortRequest):
+    count: int
+
+    @field_validator('count')
+    @classmethod
+    def validate_count(cls, v):
+        if v < 1 or v > 200:
+            raise ValueError('Count must be in range 1-200')
+        return v
+
+
 class ErrorResponse(BaseModel):
     success: bool = False
     error: str
@@ -51,6 +73,9 @@ class PortData(BaseModel):
     login: str
     password: str
     end_timestamp_utc: datetime
+    ip: str | None = None
+    city: str | None = None
+    operator: str | None = None
 
 
 class PortResponse(BaseModel):
@@ -58,3 +83,13 @@ class PortResponse(BaseModel):
     order_id: int
     data: PortData
 
+
+class OrderedPort(BaseModel):
+    order_id: int
+    data: PortData
+
+
+class PortsResponse(BaseModel):
+    success: bool = True
+    requested: int
+    ports: list[OrderedPort]
@@ -1,68 +1,73 @@
-import asyncio
-import time
-
-from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from urllib.parse import urljoin
+
+from aiohttp import ClientSession, ClientTimeout
+from bs4 import BeautifulSoup, SoupStrainer
 
-from bs4 import BeautifulSoup
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.common.by import By
+from api.utils.http_client import http_clients
+from api.utils.seller_adapters import seller_adapter
+from database.models import Sellers
 
-from database.operations.bot_operations import get_ports, get_sellers_ports
-from database.operations.website_sync_operations import upsert_update_ports, deactivate_ports
 
+GLWEB_LOGIN_URL = 'https://glweb.studio/login/'
 
-async def glweb_synchronize(seller_id: int, geo_id: int, site_login: str, site_password: str):
-    loop = asyncio.get_event_loop()
-    with ProcessPoolExecutor() as executor:
-        list_of_ports = await loop.run_in_executor(executor, extract_ports, site_login, site_password)
 
-    for port in list_of_ports:
-        port['geo_id'] = geo_id
+@seller_adapter('glweb.studio', geo='ua')
+async def glweb_ports(seller: Sellers):
+    return await extract_ports(seller.login, seller.password)
 
-    db_ports_before = await get_sellers_ports(seller_id=seller_id)
-    db_port_ids_before = set([port.port_id for port in db_ports_before])
 
-    affected_port_ids = await upsert_update_ports(seller_id=seller_id, ports=list_of_ports)
-    # print("UPDATED/INSTRTEDDDD")
-    affected_port_ids = set(affected_port_ids)
+async def extract_ports(site_login: str, site_password: str):
+    # Own cookie jar per seller account, connections still come from the shared pool
+    async with ClientSession(connector=http_clients.session.connector, connector_owner=False,
+                             timeout=ClientTimeout(total=30)) as session:
+        # Step 1: Load the Login Form (keeps hidden fields such as the CSRF token)
+        async with session.get(GLWEB_LOGIN_URL) as response:
+            login_page = await response.text()
+            login_url = str(response.url)
 
-    to_deavtivate_ids = db_port_ids_before - affected_port_ids
+        action, form_data = parse_login_form(login_page, site_login, site_password)
 
-    await deactivate_ports(seller_id=1, port_ids=list(to_deavtivate_ids))
-    # print("DEACTIVATEEDD")
+        # Step 2: Log in, the redirect lands on the proxy list
+        async with session.post(urljoin(login_url, action), data=form_data) as response:
+            proxies_page = await response.text()
 
+    if 'id="select-proxy"' not in proxies_page:
+        raise RuntimeError('glweb.studio login failed, proxy list not found')
 
-def extract_ports(site_login: str, site_password: str):
-    chrome_options = Options()
-    chrome_options.add_argument("--headless=new")
-    chrome_options.add_argument("--no-sandbox")
+    return parse_ports(proxies_page)
 
-    driver = webdriver.Chrome(options=chrome_options)
-    driver.get("https://glweb.studio/login/")
 
-    WebDriverWait(driver, 10).until(EC.element_to_be_clickable((By.XPATH, "/html/body/div[2]/form/div[2]/div[1]/input")))
+def parse_login_form(html: str, site_login: str, site_password: str) -> tuple[str, dict]:
+    form = BeautifulSoup(html, 'html.parser').find('form')
+    if not form:
+        raise RuntimeError('glweb.studio login form not found')
 
-    login_input = driver.find_element(By.XPATH, "/html/body/div[2]/form/div[2]/div[1]/input")
-    password_input = driver.find_element(By.XPATH, "/html/body/div[2]/form/div[2]/div[2]/input")
+    form_data = {}
+    login_filled = False
+    for field in form.find_all('input'):
+        name = field.get('name')
+        if not name:
+            continue
 
-    login_input.send_keys(site_login)
-    password_input.send_keys(site_password)
+        field_type = (field.get('type') or 'text').lower()
+        if field_type == 'password':
+            form_data[name] = site_password
+        elif field_type in ('text', 'email') and not login_filled:
+            form_data[name] = site_login
+            login_filled = True
+        elif field_type not in ('submit', 'button', 'checkbox'):
+            form_data[name] = field.get('value', '')
 
-    submit_button = driver.find_element(By.XPATH, "/html/body/div[2]/form/div[4]/button")
-    submit_button.click()
+    return form.get('action') or '', form_data
 
-    WebDriverWait(driver, 10).until(EC.element_to_be_clickable((By.XPATH, '//*[@id="select-proxy"]')))
-    time.sleep(1)
 
-    elements = driver.find_elements(By.CLASS_NAME, 'myproxy__block')
+def parse_ports(html: str) -> list[dict]:
+    """Parse the glweb.studio proxy list page, only the myproxy__block elements are parsed."""
+    blocks = BeautifulSoup(html, 'html.parser', parse_only=SoupStrainer('div', class_='myproxy__block'))
     list_of_ports = []
 
-    for element in elements:
-        soup = BeautifulSoup(element.get_attribute('innerHTML'), 'html.parser')
+    for soup in blocks.find_all('div', class_='myproxy__block'):
         div1 = soup.find('div', class_='myproxy__descr-port')
         div2 = soup.find('div', class_='myproxy__descr-login')
         div3 = soup.find('div', class_='myproxy__descr-link')
@@ -93,7 +98,6 @@ def extract_ports(site_login: str, site_password: str):
             'rent_end': rent_end
         })
 
-    driver.quit()
     return list_of_ports
 
 
@@ -108,5 +112,5 @@ def parse_custom_datetime(date_str):
 
 if __name__ == '__main__':
     import asyncio
-    asyncio.run(glweb_synchronize(1, 1, 'smaxim02', 'Artanden123'))
+    print(asyncio.run(extract_ports('smaxim02', 'Artanden123')))
 #
@@ -0,0 +1,86 @@
+import asyncio
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+
+import aiohttp_socks
+from aiohttp import ClientSession, TCPConnector
+
+from config import HTTP_POOL_LIMIT, HTTP_POOL_LIMIT_PER_HOST, HTTP_DNS_CACHE_TTL, HTTP_KEEPALIVE_TIMEOUT, \
+    HTTP_SOCKS_SESSIONS
+
+
+class HttpClients:
+    """
+    One keep-alive session for plain and HTTP-proxied requests and one cached session per SOCKS proxy.
+    Started by the API lifespan and the bot, whichever comes first; starting twice is a no-op.
+    """
+
+    def __init__(self):
+        self._session: ClientSession | None = None
+        self._socks_sessions: OrderedDict[str, ClientSession] = OrderedDict()
+        self._socks_users: dict[ClientSession, int] = {}
+
+    async def start(self):
+        if not self._session or self._session.closed:
+            self._session = self._new_session()
+
+    @property
+    def session(self) -> ClientSession:
+        # Scripts that never call start() still get a session, it just isn't closed explicitly
+        if not self._session or self._session.closed:
+            self._session = self._new_session()
+        return self._session
+
+    @staticmethod
+    def _new_session() -> ClientSession:
+        connector = TCPConnector(
+            limit=HTTP_POOL_LIMIT,
+            limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+            ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+            keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+        )
+        return ClientSession(connector=connector)
+
+    @asynccontextmanager
+    async def socks_session(self, proxy_url: str):
+        """
+        Session for one SOCKS proxy, only valid inside the `async with`. A session evicted from the cache
+        while it is in use is closed by its last user.
+        """
+        session = self._socks_sessions.get(proxy_url)
+        if session and not session.closed:
+            self._socks_sessions.move_to_end(proxy_url)
+        else:
+            connector = aiohttp_socks.ProxyConnector.from_url(proxy_url, keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT)
+            session = ClientSession(connector=connector)
+            self._socks_sessions[proxy_url] = session
+            await self._evict_socks_sessions()
+
+        self._socks_users[session] = self._socks_users.get(session, 0) + 1
+        try:
+            yield session
+        finally:
+            self._socks_users[session] -= 1
+            if not self._socks_users[session]:
+                del self._socks_users[session]
+                if self._socks_sessions.get(proxy_url) is not session:
+                    await session.close()
+
+    async def _evict_socks_sessions(self):
+        while len(self._socks_sessions) > HTTP_SOCKS_SESSIONS:
+            _, evicted = self._socks_sessions.popitem(last=False)
+            if evicted not in self._socks_users:
+                await evicted.close()
+
+    async def close(self):
+        sessions = {*self._socks_sessions.values(), *self._socks_users}
+        if self._session:
+            sessions.add(self._session)
+
+        self._session = None
+        self._socks_sessions = OrderedDict()
+        self._socks_users = {}
+        await asyncio.gather(*(session.close() for session in sessions if not session.closed))
+
+
+http_clients = HttpClients()
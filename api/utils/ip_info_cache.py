@@ -0,0 +1,113 @@
+import asyncio
+import ipaddress
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+
+from database.operations.api_port_transactions import get_ip_metadata, save_ip_metadata
+
+
+def cache_key(ip: str, by_prefix: bool) -> str:
+    if not by_prefix:
+        return ip
+
+    prefix = 24 if ipaddress.ip_address(ip).version == 4 else 64
+    return str(ipaddress.ip_network(f'{ip}/{prefix}', strict=False))
+
+
+def _age_seconds(fetched_at: datetime) -> float:
+    if fetched_at.tzinfo is None:
+        fetched_at = fetched_at.replace(tzinfo=timezone.utc)
+    return (datetime.now(timezone.utc) - fetched_at).total_seconds()
+
+
+class IPInfoCache:
+    """
+    City, region and org of an IP, kept in memory (LRU) and in the ip_metadata table for `ttl` seconds.
+    Misses that come within `batch_delay` of each other are looked up in one batch,
+    and a key that is already being looked up is never requested again.
+    """
+
+    def __init__(self, fetch_batch, ttl: int, max_size: int, by_prefix: bool, batch_delay: float):
+        self._fetch_batch = fetch_batch     # async (list of ips) -> {ip: ipinfo.io data}
+        self._ttl = ttl
+        self._max_size = max_size
+        self._by_prefix = by_prefix
+        self._batch_delay = batch_delay
+
+        self._entries: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+        self._pending: dict[str, asyncio.Future] = {}
+        self._batch: dict[str, str] = {}
+        self._flush_task: asyncio.Task | None = None
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, ip: str) -> dict | None:
+        key = cache_key(ip, self._by_prefix)
+
+        entry = self._entries.get(key)
+        if entry and entry[0] > time.time():
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return {'ip': ip, **entry[1]}
+
+        future = self._pending.get(key)
+        if not future:
+            self.misses += 1
+            future = asyncio.get_running_loop().create_future()
+            self._pending[key] = future
+            self._batch[key] = ip
+            if not self._flush_task:
+                self._flush_task = asyncio.create_task(self._flush())
+
+        data = await asyncio.shield(future)
+        return {'ip': ip, **data} if data else None
+
+    async def _flush(self):
+        await asyncio.sleep(self._batch_delay)
+        batch, self._batch, self._flush_task = self._batch, {}, None
+
+        try:
+            found = await self._lookup(batch)
+        except Exception as e:
+            print(f"IP info lookup failed: {e}")
+            found = {}
+
+        for key in batch:
+            data = None
+            if key in found:
+                expires_at, data = found[key]
+                self._store(key, expires_at, data)
+            self._pending.pop(key).set_result(data)
+
+    async def _lookup(self, batch: dict[str, str]) -> dict[str, tuple[float, dict]]:
+        # Step 1: Look in the ip_metadata Table
+        rows = await get_ip_metadata(list(batch), datetime.utcnow() - timedelta(seconds=self._ttl))
+        found = {row.key: (time.time() + self._ttl - _age_seconds(row.fetched_at),
+                           dict(city=row.city, region=row.region, org=row.org))
+                 for row in rows}
+
+        # Step 2: Ask ipinfo.io for the rest and persist the answers
+        missing = {key: ip for key, ip in batch.items() if key not in found}
+        if not missing:
+            return found
+
+        fetched = await self._fetch_batch(list(missing.values()))
+        new_rows = []
+        for key, ip in missing.items():
+            data = fetched.get(ip)
+            if not isinstance(data, dict):
+                continue
+            data = dict(city=data.get('city'), region=data.get('region'), org=data.get('org'))
+            found[key] = (time.time() + self._ttl, data)
+            new_rows.append(dict(key=key, fetched_at=datetime.utcnow(), **data))
+
+        if new_rows:
+            await save_ip_metadata(new_rows)
+        return found
+
+    def _store(self, key: str, expires_at: float, data: dict):
+        self._entries[key] = (expires_at, data)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
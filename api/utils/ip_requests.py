@@ -1,38 +1,38 @@
+import asyncio
+from dataclasses import dataclass
 
-import aiohttp
-from aiohttp import ClientSession
-import aiohttp_socks
+from api.utils.http_client import http_clients
+from api.utils.ip_info_cache import IPInfoCache
+from config import IP_INFO_KEY, PROBE_HEDGE_DELAY, IP_INFO_CACHE_TTL, IP_INFO_CACHE_SIZE, IP_INFO_CACHE_BY_PREFIX, \
+    IP_INFO_BATCH_DELAY
 
-from config import IP_INFO_KEY
-
-async def rotate_proxy(session: ClientSession, rotation_link: str):
-    async with session.get(rotation_link, ssl=False, timeout=20) as response:
+async def rotate_proxy(rotation_link: str):
+    async with http_clients.session.get(rotation_link, ssl=False, timeout=20) as response:
         if response.status == 200:
             return True
 
 
 async def get_socks_proxy_ip(host: str, port: int, login: str, password: str):
-    connector = aiohttp_socks.ProxyConnector.from_url(f'socks5://{login}:{password}@{host}:{port}')
     link = 'https://api.my-ip.io/v2/ip.json'
 
-    async with aiohttp.ClientSession(connector=connector) as session:
-        try:
+    try:
+        async with http_clients.socks_session(f'socks5://{login}:{password}@{host}:{port}') as session:
             async with session.get(link, ssl=False) as response:
                 if response.status == 200:
                     data = await response.json()
                     return data['ip'], int(data['type'][-1])
                 else:
                     return None, None
-        except Exception:
-            return None, None
+    except Exception:
+        return None, None
 
 
-async def get_http_proxy_ip(session: ClientSession, host: str, port: int, login: str, password: str):
+async def get_http_proxy_ip(host: str, port: int, login: str, password: str):
     link = 'https://api.my-ip.io/v2/ip.json'
     link = 'https://v4v6.ipv6-test.com/api/myip.php?json'
 
     try:
-        async with session.get(link, ssl=False, timeout=55, proxy=f'http://{login}:{password}@{host}:{port}') as response:
+        async with http_clients.session.get(link, ssl=False, timeout=55, proxy=f'http://{login}:{password}@{host}:{port}') as response:
             if response.status == 200:
                 data = await response.json()
                 return data['address'], int(data['proto'][-1])
@@ -43,27 +43,108 @@ async def get_http_proxy_ip(session: ClientSession, host: str, port: int, login:
 
 
 
-async def get_ip_info(session: ClientSession, ip: str):
-    import dotenv
-    dotenv.load_dotenv(r'D:\fun_project\proxyManager\.env')
-    async with session.get(f'https://ipinfo.io/{ip}?token={IP_INFO_KEY}', ssl=False) as response:
-        if response.status == 200:
-            return await response.json()
-        else:
-            return None
+async def fetch_ip_info_batch(ips: list[str]) -> dict:
+    """Look the IPs up on ipinfo.io, returns {ip: data} for the ones that were found."""
+    if len(ips) == 1:
+        async with http_clients.session.get(f'https://ipinfo.io/{ips[0]}?token={IP_INFO_KEY}', ssl=False) as response:
+            if response.status == 200:
+                return {ips[0]: await response.json()}
+            return {}
 
+    found = {}
+    for start in range(0, len(ips), 1000):      # Batch endpoint takes up to 1000 IPs
+        async with http_clients.session.post(f'https://ipinfo.io/batch?token={IP_INFO_KEY}',
+                                             json=ips[start:start + 1000], ssl=False) as response:
+            if response.status == 200:
+                found.update(await response.json())
+    return found
 
-async def get_http_proxy_ip_multitry(session: ClientSession, host: str, port: int, login: str, password: str):
-    tasks = [get_http_proxy_ip(session, host, port, login, password) for _ in range(5)]
-    try:
-        for task in asyncio.as_completed(tasks, timeout=60):
-            ip, ip_ver = await task
-            if ip:
-                return ip, ip_ver
 
-        return None, None
-    except asyncio.TimeoutError:
-        return None, None
+ip_info_cache = IPInfoCache(fetch_ip_info_batch, IP_INFO_CACHE_TTL, IP_INFO_CACHE_SIZE, IP_INFO_CACHE_BY_PREFIX,
+                            IP_INFO_BATCH_DELAY)
+
+
+async def get_ip_info(ip: str):
+    return await ip_info_cache.get(ip)
+
+
+@dataclass
+class ProbeAttempt:
+    number: int
+    latency: float
+    success: bool
+    cancelled: bool = False
+
+
+@dataclass
+class ProbeResult:
+    ip: str | None
+    ip_version: int | None
+    attempts: list[ProbeAttempt]
+
+
+async def hedged_probe(probe, attempts: int, hedge_delay: float, timeout: float) -> ProbeResult:
+    """
+    Run `probe()` (a coroutine factory returning (ip, ip_version)) with hedging: the next attempt starts
+    only when the previous ones failed or didn't answer within `hedge_delay`. Everything still running
+    is cancelled as soon as one attempt succeeds or `timeout` runs out.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    running = {}        # task -> (attempt number, start time)
+    finished = []
+    started = 0
+    next_hedge_at = loop.time()
+
+    try:
+        while True:
+            if started < attempts and (not running or loop.time() >= next_hedge_at):
+                started += 1
+                running[asyncio.create_task(probe())] = (started, loop.time())
+                next_hedge_at = loop.time() + hedge_delay
+
+            if not running:
+                return ProbeResult(None, None, finished)
+
+            now = loop.time()
+            if now >= deadline:
+                return ProbeResult(None, None, finished)
+
+            wait_for = deadline - now
+            if started < attempts:
+                wait_for = min(wait_for, max(next_hedge_at - now, 0))
+
+            done, _ = await asyncio.wait(running, timeout=wait_for, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                number, started_at = running.pop(task)
+                ip, ip_version = task.result()
+                finished.append(ProbeAttempt(number, loop.time() - started_at, bool(ip)))
+                if ip:
+                    return ProbeResult(ip, ip_version, finished)
+    finally:
+        for task, (number, started_at) in running.items():
+            task.cancel()
+            finished.append(ProbeAttempt(number, loop.time() - started_at, False, cancelled=True))
+
+
+async def probe_http_proxy_ip(host: str, port: int, login: str, password: str,
+                              attempts: int = 5, hedge_delay: float = PROBE_HEDGE_DELAY) -> ProbeResult:
+    return await hedged_probe(lambda: get_http_proxy_ip(host, port, login, password),
+                              attempts, hedge_delay, timeout=60)
+
+
+def format_attempts(attempts: list[ProbeAttempt]) -> str:
+    return ', '.join(f"#{attempt.number} {attempt.latency:.2f}s "
+                     f"{'cancelled' if attempt.cancelled else 'ok' if attempt.success else 'failed'}"
+                     for attempt in sorted(attempts, key=lambda attempt: attempt.number))
+
+
+async def get_http_proxy_ip_multitry(host: str, port: int, login: str, password: str):
+    result = await probe_http_proxy_ip(host, port, login, password)
+    # A single answered attempt is the normal case, anything else is worth seeing
+    if len(result.attempts) > 1 or not result.ip:
+        print(f"Probe of {host}:{port}: {format_attempts(result.attempts)}")
+    return result.ip, result.ip_version
 
 
 
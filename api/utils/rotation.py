@@ -0,0 +1,118 @@
+import asyncio
+import time
+from collections import defaultdict
+from contextlib import contextmanager, AsyncExitStack
+from dataclasses import dataclass
+
+from api.utils.ip_requests import rotate_proxy, get_socks_proxy_ip, get_ip_info, probe_http_proxy_ip
+from config import ROTATION_CONCURRENCY, ROTATION_PER_HOST, ROTATION_PER_SELLER
+from database.operations.api_port_transactions import get_port_for_rotation, create_new_ip_info, \
+    delete_port_response, finish_request_and_response
+
+
+@dataclass
+class StageTiming:
+    count: int = 0
+    total: float = 0
+    max: float = 0
+
+    def add(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    @property
+    def average(self) -> float:
+        return self.total / self.count if self.count else 0
+
+
+class RotationPool:
+    """
+    Ends rents and rotates their ports. Rotations for different modem hosts run in parallel, capped
+    at `concurrency` in total and at `per_host`/`per_seller` against a single host or seller.
+    """
+
+    def __init__(self, concurrency: int, per_host: int, per_seller: int):
+        self._slots = asyncio.Semaphore(concurrency)
+        self._hosts = defaultdict(lambda: asyncio.Semaphore(per_host))
+        self._sellers = defaultdict(lambda: asyncio.Semaphore(per_seller))
+        self.queued = 0
+        self.running = 0
+        self.timings: dict[str, StageTiming] = defaultdict(StageTiming)
+
+    @contextmanager
+    def _stage(self, name: str):
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name].add(time.perf_counter() - started_at)
+
+    async def end_rent(self, response_id: int, auto: bool = False):
+        # Step 1: Close the Rent, so rent_ended_at is not delayed by the rotation queue
+        with self._stage('finish'):
+            closed = await finish_request_and_response(response_id, auto)
+
+        try:
+            # Step 2: Rotate the Port and save its new IP Info, only once per rent. A rent closed before
+            # (a crash or a failed rotation before Step 3) still gets its port released below
+            if closed:
+                port = await get_port_for_rotation(response_id)
+                if port and port.rotation_link:
+                    await self._rotate(port)
+        except Exception as e:
+            print(f"Rotation for response {response_id} failed: {e}")
+        finally:
+            # Step 3: Return the Port to the pool
+            with self._stage('release'):
+                await delete_port_response(response_id)
+
+    async def _rotate(self, port):
+        async with AsyncExitStack() as slots:
+            # Seller, host, then global slot, always in this order
+            self.queued += 1
+            try:
+                with self._stage('queue'):
+                    for semaphore in (self._sellers[port.seller_id], self._hosts[port.host], self._slots):
+                        await slots.enter_async_context(semaphore)
+            finally:
+                self.queued -= 1
+
+            self.running += 1
+            try:
+                with self._stage('rotate'):
+                    await rotate_proxy(port.rotation_link)
+
+                with self._stage('probe'):
+                    if port.http_port:
+                        probe = await probe_http_proxy_ip(port.host, port.http_port, port.login, port.password)
+                        ip, ip_ver = probe.ip, probe.ip_version
+                        # Every hedged attempt on its own, cancelled ones separately as they never got an answer
+                        for attempt in probe.attempts:
+                            stage = 'probe_cancelled' if attempt.cancelled else 'probe_attempt'
+                            self.timings[stage].add(attempt.latency)
+                    else:
+                        ip, ip_ver = await get_socks_proxy_ip(port.host, port.socks_port, port.login, port.password)
+
+                if not ip:
+                    return
+
+                with self._stage('ip_info'):
+                    ip_info = await get_ip_info(ip)
+
+                with self._stage('save'):
+                    await create_new_ip_info(port.port_id, ip_info['ip'], ip_ver, ip_info['city'],
+                                             ip_info['region'], ip_info['org'])
+            finally:
+                self.running -= 1
+
+    def stats(self) -> dict:
+        return {
+            'queued': self.queued,
+            'running': self.running,
+            'stages': {name: {'count': timing.count, 'average': timing.average, 'max': timing.max}
+                       for name, timing in self.timings.items()},
+        }
+
+
+rotation_pool = RotationPool(ROTATION_CONCURRENCY, ROTATION_PER_HOST, ROTATION_PER_SELLER)
@@ -0,0 +1,33 @@
+from dataclasses import dataclass
+from typing import Awaitable, Callable
+
+from database.models import Sellers
+
+
+@dataclass
+class SellerAdapter:
+    domain: str
+    geo: str
+    fetch_ports: Callable[[Sellers], Awaitable[list[dict]]]
+
+
+SELLER_ADAPTERS: list[SellerAdapter] = []
+
+
+def seller_adapter(domain: str, geo: str):
+    """
+    Register a seller site. The decorated coroutine gets the seller and returns its ports as dicts with
+    host, http_port, socks_port, login, password, rotation_link and rent_end.
+    """
+    def register(fetch_ports):
+        SELLER_ADAPTERS.append(SellerAdapter(domain, geo, fetch_ports))
+        return fetch_ports
+
+    return register
+
+
+def find_seller_adapter(site_link: str | None) -> SellerAdapter | None:
+    for adapter in SELLER_ADAPTERS:
+        if site_link and adapter.domain in site_link:
+            return adapter
+    return None
@@ -1,78 +1,100 @@
-from datetime import datetime, timedelta
-
-from aiohttp import ClientSession
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
-
-from api.utils.glweb_ports import glweb_synchronize
-from api.utils.ip_requests import rotate_proxy, get_socks_proxy_ip, get_ip_info, get_http_proxy_ip_multitry
-from database.operations.api_port_transactions import check_waiting_requests, free_missed_port, get_expired_responses, \
-    get_port_for_rotation, create_new_ip_info, delete_port_response, finish_request_and_response, get_waiting_requests
-from database.operations.website_sync_operations import get_all_sellers, get_geo_id, get_sync_status
-from database.session import SessionLocal
-
-scheduler = AsyncIOScheduler()
-
-
-async def waiting_requests_check():
-    waiting_requests = await get_waiting_requests()
+import asyncio
+import time
+from datetime import datetime
+
+import api.utils.glweb_ports       # noqa: F401, registers the glweb.studio adapter
+from api.utils.rotation import rotation_pool
+from api.utils.seller_adapters import find_seller_adapter
+from config import SYNC_CONCURRENCY, SYNC_SELLER_TIMEOUT
+from database.deadlines import deadlines
+from database.enums import ResponseStatus
+from database.operations.api_port_transactions import assign_port_to_waiting_request, free_missed_port
+from database.operations.website_sync_operations import get_all_sellers, get_geo_id, get_sync_status, \
+    upsert_update_ports, record_seller_sync
+from database.port_index import free_ports
+from database.waiting_queue import waiting_queue
+
+
+# Delay before retrying after a failed assignment, doubled on every failure in a row
+WAITING_RETRY_DELAY = 0.1
+WAITING_MAX_RETRY_DELAY = 5
+
+
+async def serve_waiting_requests():
+    # Runs for the whole app lifetime, woken up every time a port is freed or a new request starts waiting
+    retry_delay = WAITING_RETRY_DELAY
+    while True:
+        await waiting_queue.wait()
+        while waiter := waiting_queue.pop_servable():
+            try:
+                response_id = await assign_port_to_waiting_request(waiter)
+            except Exception as e:
+                # The waiter is already back in the queue, don't retry it right away
+                print(f"Failed to assign a port to request {waiter.request_id}: {e}")
+                await asyncio.sleep(retry_delay)
+                retry_delay = min(retry_delay * 2, WAITING_MAX_RETRY_DELAY)
+                break
+
+            retry_delay = WAITING_RETRY_DELAY
+            if response_id:
+                waiting_queue.mark_served(waiter.request_id)
+
+
+async def handle_deadline(response_id: int, status: ResponseStatus):
+    # Unclaimed holds go back to the pool, everything else is a rent that ran out
+    if status == ResponseStatus.PORT_WAITING:
+        await free_missed_port(response_id)
+        return
 
-    found_ports = await check_waiting_requests(waiting_requests)
+    await end_proxy_port_rent(response_id, auto=True)
 
-    run_time = datetime.now() + timedelta(seconds=60)
-    for port_response_id in found_ports:
-        scheduler.add_job(free_missed_port, "date", run_date=run_time, args=[port_response_id])
 
+async def end_proxy_port_rent(response_id: int, auto: bool = False):
+    deadlines.cancel(response_id)
+    await rotation_pool.end_rent(response_id, auto)
 
-async def handle_expired_port_rents():
-    response_ids = await get_expired_responses()
 
-    if not response_ids:
+async def synchronize_ports():
+    if not await get_sync_status():
         return
 
-    http_session = ClientSession()
-
-    # Didn't use asyncio.gather here, not to overload the server with transactions/requests
-    for response_id in response_ids:
-        await end_proxy_port_rent(response_id, http_session)
+    sellers = await get_all_sellers()
+    slots = asyncio.Semaphore(SYNC_CONCURRENCY)
 
+    async def sync(seller):
+        async with slots:
+            await sync_seller(seller)
 
-async def end_proxy_port_rent(
-        response_id: int,
-        http_session: ClientSession = None
-):
+    await asyncio.gather(*(sync(seller) for seller in sellers))
 
-    db = SessionLocal()
-    if not http_session:
-        http_session = ClientSession()
 
-    async with db, http_session:
-        await finish_request_and_response(response_id)
-        port = await get_port_for_rotation(response_id)
+async def sync_seller(seller):
+    adapter = find_seller_adapter(seller.site_link)
+    if not adapter:
+        return
 
-        if port and port.rotation_link:
-            await rotate_proxy(http_session, port.rotation_link)
-            if port.http_port:
-                ip, ip_ver = await get_http_proxy_ip_multitry(http_session, port.host, port.http_port, port.login, port.password)
-            else:
-                ip, ip_ver = await get_socks_proxy_ip(port.host, port.socks_port, port.login, port.password)
-            print(ip, ip_ver)
-            if ip:
-                ip_info = await get_ip_info(http_session, ip)
-                await create_new_ip_info(port.port_id, ip_info['ip'], ip_ver, ip_info['city'], ip_info['region'], ip_info['org'])
+    started_at = datetime.utcnow()
+    start = time.perf_counter()
+    summary = error = None
+    try:
+        summary = await asyncio.wait_for(_sync_seller_ports(seller, adapter), SYNC_SELLER_TIMEOUT)
+    except asyncio.TimeoutError:
+        error = f"Timed out after {SYNC_SELLER_TIMEOUT} s"
+    except Exception as e:
+        error = repr(e)
 
-        # if port.rotation_type == RotationType.STATIC:
-        #     pass
+    duration = time.perf_counter() - start
+    print(f"Seller {seller.seller_id} synced in {duration:.1f} s: {summary or error}")
+    await record_seller_sync(seller.seller_id, started_at, duration, str(summary) if summary else None, error)
 
-        await delete_port_response(response_id)
 
+async def _sync_seller_ports(seller, adapter):
+    ports = await adapter.fetch_ports(seller)
 
-async def synchronize_ports():
-    if not await get_sync_status():
-        return
-    all_sellers = await get_all_sellers()
-    for s in all_sellers:
-        if 'glweb.studio' in s.site_link:
-            geo = 'ua'
-            geo_id = await get_geo_id(geo)
-            await glweb_synchronize(s.seller_id, geo_id, s.login, s.password)
+    geo_id = await get_geo_id(adapter.geo)
+    for port in ports:
+        port['geo_id'] = geo_id
 
+    summary = await upsert_update_ports(seller.seller_id, ports)
+    await free_ports.refresh(summary.touched_port_ids)
+    return summary
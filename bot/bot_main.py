@@ -3,6 +3,7 @@ from aiogram import Bot, Dispatcher, filters, types, F
 from aiogram.utils.keyboard import ReplyKeyboardBuilder
 
 from config import TG_BOT_TOKEN
+from api.utils.http_client import http_clients
 from bot.core.middlewares import AccessMiddleware
 from bot.routers.seller import seller_router
 from bot.routers.statistics import statistics_router
@@ -46,5 +47,9 @@ async def start_bot():
     scheduler.add_job(rent_end_check, 'interval', hours=6, args=[bot])
     scheduler.start()
 
-    await dp.start_polling(bot)
+    await http_clients.start()
+    try:
+        await dp.start_polling(bot)
+    finally:
+        await http_clients.close()
 
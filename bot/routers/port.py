@@ -3,7 +3,6 @@ from datetime import datetime
 from aiogram import Router, types, F
 from aiogram.utils.keyboard import ReplyKeyboardBuilder, InlineKeyboardBuilder
 from aiogram.fsm.context import FSMContext
-from aiohttp import ClientSession
 
 from api.utils.ip_requests import get_http_proxy_ip_multitry, get_socks_proxy_ip, get_ip_info
 from database.models import Sellers, Ports, ProxyTypes, Geos
@@ -12,6 +11,7 @@ from database.operations.bot_operations import (get_sellers, get_sellers_ports,
 from bot.core.states import ShowPorts, NewPort, TurnOnOffPort
 from bot.core.callbacks import InlinePageCallback
 from database.operations.api_port_transactions import create_new_ip_info
+from database.port_index import free_ports
 
 port_router = Router()
 
@@ -290,23 +290,22 @@ async def save_new_port(message: types.Message, state: FSMContext):
     }
 
     try:
-        http_session = ClientSession()
         port_id = await add_port(data)
         # if proxy_protocol == 'http':
-        ip, ip_ver = await get_http_proxy_ip_multitry(http_session, host, int(http_port), login, password)
+        ip, ip_ver = await get_http_proxy_ip_multitry(host, int(http_port), login, password)
         # else:
         #     ip, ip_ver = await get_socks_proxy_ip(host, port, login, password)
 
         if ip:
             await add_port_ip_version(port_id, ip_ver)
-            ip_info = await get_ip_info(http_session, ip)
+            ip_info = await get_ip_info(ip)
             await create_new_ip_info(port_id, ip_info['ip'], ip_ver, ip_info['city'], ip_info['region'],
                                      ip_info['org'])
+            await free_ports.refresh([port_id])
         else:
             await delete_port(port_id)
 
         await message.answer('Порт доданий')
-        await http_session.close()
     except Exception as e:
         print(e)
         await message.answer('Виникла помилка, почніть спочатку')
@@ -1,4 +1,7 @@
-import io
+import asyncio
+import os
+import tempfile
+from collections import Counter
 from datetime import datetime, date, timedelta
 from zoneinfo import ZoneInfo
 
@@ -7,8 +10,10 @@ from aiogram import Router, types, F
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.fsm.context import FSMContext
 
-from database.operations.bot_operations import count_requests, get_ports, get_busy_time_for_port
+from database.operations.bot_operations import count_requests, get_ports, get_port_usage
 from bot.core.states import Statistics
+from database.analytics import fetch_rents, to_intervals, to_timestamp, clip, peak_concurrency_by_key, \
+    hold_time_percentiles, weekly_heatmap
 
 statistics_router = Router()
 
@@ -42,19 +47,22 @@ async def save_custom_period(message: types.Message, state: FSMContext):
     else:
         start = end = datetime.strptime(message.text.strip(), '%d.%m.%Y')
 
+    # Half-open range [first day 00:00, day after the last one 00:00) in UTC
+    start = start.replace(tzinfo=ZoneInfo('UTC'))
+    end = end.replace(tzinfo=ZoneInfo('UTC')) + timedelta(days=1)
     await state.update_data(start_date=start, end_date=end)
     await show_statistics(message, state)
 
 
 @statistics_router.callback_query(Statistics.choosing_time_period)
 async def save_date(callback: types.CallbackQuery, state: FSMContext):
+    # Half-open ranges ending at the start of tomorrow (UTC)
+    end = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=ZoneInfo('UTC')) + timedelta(days=1)
     if callback.data == 'today':
-        start = end = datetime.utcnow().replace(hour=23, minute=59, second=59, microsecond=999999, tzinfo=ZoneInfo('UTC'))
+        start = end - timedelta(days=1)
     elif callback.data == 'week':
-        end = datetime.utcnow().replace(hour=23, minute=59, second=59, microsecond=999999, tzinfo=ZoneInfo('UTC'))
         start = end - timedelta(days=7)
     elif callback.data == 'month':
-        end = datetime.utcnow().replace(hour=23, minute=59, second=59, microsecond=999999, tzinfo=ZoneInfo('UTC'))
         start = end - timedelta(days=30)
 
     await callback.answer()
@@ -69,63 +77,139 @@ async def show_statistics(message: types.Message, state: FSMContext):
 
     total_time_in_range = (end - start).total_seconds()
 
-    requests = await count_requests(start, end)
+    request_counts = await count_requests(start, end)
+    requests = sum(row.requests for row in request_counts)
+    by_status, by_geo = Counter(), Counter()
+    for row in request_counts:
+        by_status[row.status.name if row.status else '-'] += row.requests
+        by_geo[row.geo or '-'] += row.requests
 
-    await message.answer(f'Загальний час: {total_time_in_range}\nКількість запитів: {requests}')
-    await state.clear()
+    rents = await fetch_rents(start, end)
     all_ports = await get_ports()
+    usage = await get_port_usage(start, end)
+    await state.clear()
+
     ports_data = {}
     for port in all_ports:
-        busy_time = await get_busy_time_for_port(start, end, port.port_id)
-        busy_time = int(busy_time)
+        port_usage = usage.get(port.port_id)
+        busy_time = int(port_usage.busy_seconds) if port_usage else 0
         ports_data[port.port_id] = {"busy_time": seconds_to_time(busy_time),
                                     "free_time": seconds_to_time(total_time_in_range - busy_time),
+                                    "rentals": port_usage.rentals if port_usage else 0,
+                                    "clients": port_usage.clients if port_usage else 0,
                                     "host": port.host,
                                     "http_port": port.http_port,
                                     "socks_port": port.socks_port}
 
-    buffer = write_statistics_to_xlsx(f"{start.strftime('%d.%m.%Y')} - {end.strftime('%d.%m.%Y')}", requests, ports_data)
-    input_file = types.BufferedInputFile(buffer.getvalue(), filename='statistics.xlsx')
-    await message.answer_document(input_file)
-    await state.clear()
-
-
-def write_statistics_to_xlsx(date_range: str, requests:int, ports_data: dict):
-    buffer = io.BytesIO()
-    buffer.name = 'statistics.xlsx'
-
-    workbook = xlsxwriter.Workbook(buffer)
-    worksheet = workbook.add_worksheet()
-
-    head_format = workbook.add_format({'align': 'center', 'valign': 'vcenter', 'border': 1, 'font_size': 14,'bold': True})
-    bold_table_head_format = workbook.add_format({'align': 'center', 'valign': 'vcenter', 'bg_color': '#e3e538', 'border': 2, 'font_size': 12, 'bold': True})
-    normal_format = workbook.add_format({'align': 'center', 'valign': 'vcenter', 'border': 1, 'font_size': 12})
-
-    worksheet.merge_range('A1:F2', f'Статистика за {date_range}', head_format)
-    worksheet.merge_range('B4:C4', 'Кількість запитів', bold_table_head_format)
-    worksheet.write('D4', requests, bold_table_head_format)
-
-    worksheet.merge_range('A6:D6', 'Порт', bold_table_head_format)
-    worksheet.merge_range('E6:E7', 'Час роботи', bold_table_head_format)
-    worksheet.merge_range('F6:F7', 'Час простою', bold_table_head_format)
-    worksheet.write('A7', 'ID', bold_table_head_format)
-    worksheet.write('B7', 'Хост', bold_table_head_format)
-    worksheet.write('C7', 'HTTP порт', bold_table_head_format)
-    worksheet.write('D7', 'SOCKS порт', bold_table_head_format)
-
-    for row, port_id in enumerate(ports_data.keys(), start=8):
-        worksheet.write(f'A{row}', port_id, normal_format)
-        worksheet.write(f'B{row}', ports_data[port_id]['host'], normal_format)
-        worksheet.write(f'C{row}', ports_data[port_id]['http_port'], normal_format)
-        worksheet.write(f'D{row}', ports_data[port_id]['socks_port'], normal_format)
-        worksheet.write(f'E{row}', ports_data[port_id]['busy_time'], normal_format)
-        worksheet.write(f'F{row}', ports_data[port_id]['free_time'], normal_format)
-
-    worksheet.autofit()
-    worksheet.set_column('A:A', width=8)
-    workbook.close()
-
-    return buffer
+    # Interval analytics and the workbook are CPU bound, they run in a worker thread,
+    # so the bot and the API keep serving while the report is built
+    date_range = f"{start.strftime('%d.%m.%Y')} - {(end - timedelta(days=1)).strftime('%d.%m.%Y')}"
+    peaks, hold_times, path = await asyncio.to_thread(build_report, date_range, start, end, rents, requests,
+                                                      ports_data, request_counts)
+    try:
+        peaks_text = ', '.join(f'{geo}: {peak}' for geo, peak in peaks.items()) or '-'
+        hold_times_text = ' / '.join(seconds_to_time(int(seconds)) for seconds in hold_times.values())
+        status_text = ', '.join(f'{status}: {count}' for status, count in by_status.most_common()) or '-'
+        geo_text = ', '.join(f'{geo}: {count}' for geo, count in by_geo.most_common()) or '-'
+        await message.answer(f'Загальний час: {total_time_in_range}\nКількість запитів: {requests}\n'
+                             f'За статусом: {status_text}\nЗа гео: {geo_text}\n'
+                             f'Пік одночасних оренд: {peaks_text}\nЧас оренди p50 / p90 / p99: {hold_times_text}')
+        await message.answer_document(types.FSInputFile(path, filename='statistics.xlsx'))
+    finally:
+        os.remove(path)
+
+
+def build_report(date_range: str, start: datetime, end: datetime, rents: list, requests: int, ports_data: dict,
+                 request_counts) -> tuple[dict, dict, str]:
+    """Runs in a worker thread. Returns peak concurrency per geo, hold time percentiles and the workbook path."""
+    intervals = to_intervals(rents)
+    lo, hi = to_timestamp(start), to_timestamp(end)
+    peaks = peak_concurrency_by_key(intervals.geos, *clip(intervals.starts, intervals.ends, lo, hi))
+    hold_times = hold_time_percentiles(intervals.starts, intervals.ends)
+    heatmap = weekly_heatmap(intervals.starts, intervals.ends, lo, hi)
+
+    path = write_statistics_to_xlsx(date_range, requests, ports_data, heatmap, request_counts)
+    return peaks, hold_times, path
+
+
+PORT_COLUMNS = ['ID', 'Хост', 'HTTP порт', 'SOCKS порт', 'Час роботи', 'Час простою', 'Оренд', 'Клієнтів']
+PORT_FIELDS = ['host', 'http_port', 'socks_port', 'busy_time', 'free_time', 'rentals', 'clients']
+REQUEST_COLUMNS = ['Статус', 'Гео', 'Логін', 'Запитів']
+
+
+def write_statistics_to_xlsx(date_range: str, requests: int, ports_data: dict, heatmap=None,
+                             request_counts=None) -> str:
+    """
+    Writes the report to a temporary file and returns its path, the caller removes it.
+    Rows are streamed to disk (constant_memory), so every sheet is written strictly top to bottom.
+    """
+    file = tempfile.NamedTemporaryFile(prefix='statistics_', suffix='.xlsx', delete=False)
+    file.close()
+
+    try:
+        workbook = xlsxwriter.Workbook(file.name, {'constant_memory': True})
+        worksheet = workbook.add_worksheet()
+
+        head_format = workbook.add_format({'align': 'center', 'valign': 'vcenter', 'border': 1, 'font_size': 14,'bold': True})
+        bold_table_head_format = workbook.add_format({'align': 'center', 'valign': 'vcenter', 'bg_color': '#e3e538', 'border': 2, 'font_size': 12, 'bold': True})
+        normal_format = workbook.add_format({'align': 'center', 'valign': 'vcenter', 'border': 1, 'font_size': 12})
+
+        # autofit() needs the whole sheet in memory, so the widths are measured up front
+        rows = [[port_id, *(port[field] for field in PORT_FIELDS)] for port_id, port in ports_data.items()]
+        for column, width in enumerate(_column_widths(PORT_COLUMNS, rows)):
+            worksheet.set_column(column, column, width)
+        worksheet.set_column('A:A', width=8)
+
+        # A row is flushed once a later row is written, so merges go top to bottom. The title spans two rows,
+        # which works only because merge_range fills both of them and nothing else is written there
+        worksheet.merge_range('A1:H2', f'Статистика за {date_range}', head_format)
+        worksheet.merge_range('B4:C4', 'Кількість запитів', bold_table_head_format)
+        worksheet.write('D4', requests, bold_table_head_format)
+
+        worksheet.merge_range('A6:D6', 'Порт', bold_table_head_format)
+        worksheet.merge_range('E6:H6', 'Використання', bold_table_head_format)
+        worksheet.write_row(6, 0, PORT_COLUMNS, bold_table_head_format)
+
+        for row, values in enumerate(rows, start=7):
+            worksheet.write_row(row, 0, values, normal_format)
+
+        if heatmap is not None:
+            # Busy hours of all ports per weekday and UTC hour
+            heatmap_sheet = workbook.add_worksheet('Heatmap')
+            heatmap_sheet.write(0, 0, 'UTC', bold_table_head_format)
+            for hour in range(24):
+                heatmap_sheet.write(0, hour + 1, hour, bold_table_head_format)
+            for day, day_name in enumerate(['Пн', 'Вт', 'Ср', 'Чт', 'Пт', 'Сб', 'Нд']):
+                heatmap_sheet.write(day + 1, 0, day_name, bold_table_head_format)
+                for hour in range(24):
+                    heatmap_sheet.write(day + 1, hour + 1, round(heatmap[day][hour] / 3600, 1), normal_format)
+            heatmap_sheet.conditional_format(1, 1, 7, 24, {'type': '3_color_scale'})
+
+        if request_counts is not None:
+            # Demand per status, geo and client, busiest first
+            rows = sorted(([row.status.name if row.status else '-', row.geo, row.login, row.requests]
+                           for row in request_counts), key=lambda row: -row[3])
+            requests_sheet = workbook.add_worksheet('Запити')
+            for column, width in enumerate(_column_widths(REQUEST_COLUMNS, rows)):
+                requests_sheet.set_column(column, column, width)
+            requests_sheet.write_row(0, 0, REQUEST_COLUMNS, bold_table_head_format)
+            for row, values in enumerate(rows, start=1):
+                requests_sheet.write_row(row, 0, values, normal_format)
+
+        workbook.close()
+    except Exception:
+        os.remove(file.name)
+        raise
+
+    return file.name
+
+
+def _column_widths(headers: list, rows: list, padding: int = 4, max_width: int = 50) -> list[int]:
+    widths = [len(str(header)) for header in headers]
+    for row in rows:
+        for column, value in enumerate(row):
+            widths[column] = max(widths[column], len(str(value)))
+    return [min(width + padding, max_width) for width in widths]
 
 
 def seconds_to_time(input_seconds: int):
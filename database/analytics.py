@@ -0,0 +1,157 @@
+from dataclasses import dataclass
+from datetime import datetime, timezone
+
+import numpy as np
+from sqlalchemy import select
+
+from database.models import Responses, IPInfo, Ports, Geos
+from database.session import SessionLocal
+
+
+def to_timestamp(value: datetime) -> float:
+    # SQLite hands back naive datetimes, they are UTC like everything stored by the app
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+
+@dataclass
+class Intervals:
+    """Closed rents as parallel arrays, times are UTC epoch seconds."""
+    port_ids: np.ndarray
+    geos: np.ndarray
+    starts: np.ndarray
+    ends: np.ndarray
+
+    def __len__(self):
+        return len(self.starts)
+
+
+async def fetch_rents(start_date: datetime, end_date: datetime) -> list:
+    """
+    (port_id, geo, created_at, rent_ended_at) of the rents that ended within or after `start_date`
+    and started before `end_date`.
+    """
+    async with SessionLocal() as session:
+        result = await session.execute(
+            select(IPInfo.port_id, Geos.name, Responses.created_at, Responses.rent_ended_at)
+            .select_from(Responses)
+            .join(IPInfo, IPInfo.ip_info_id == Responses.ip_info_id)
+            .join(Ports, Ports.port_id == IPInfo.port_id)
+            .join(Geos, Geos.geo_id == Ports.geo_id)
+            .where(Responses.rent_ended_at.isnot(None))
+            .where(Responses.rent_ended_at >= start_date)
+            .where(Responses.created_at < end_date)
+        )
+        return result.all()
+
+
+def to_intervals(rents: list) -> Intervals:
+    """Rents from fetch_rents as arrays. Loops over every row, so large ranges belong off the event loop."""
+    return Intervals(
+        port_ids=np.fromiter((row[0] for row in rents), dtype=np.int64, count=len(rents)),
+        geos=np.array([row[1] for row in rents], dtype=str),
+        starts=np.fromiter((to_timestamp(row[2]) for row in rents), dtype=np.float64, count=len(rents)),
+        ends=np.fromiter((to_timestamp(row[3]) for row in rents), dtype=np.float64, count=len(rents)),
+    )
+
+
+def clip(starts: np.ndarray, ends: np.ndarray, lo: float, hi: float):
+    """Clip intervals to [lo, hi], intervals outside of it become empty (start == end)."""
+    clipped_starts = np.clip(starts, lo, hi)
+    clipped_ends = np.clip(ends, clipped_starts, hi)
+    return clipped_starts, clipped_ends
+
+
+def busy_time_by_key(keys: np.ndarray, starts: np.ndarray, ends: np.ndarray, lo: float, hi: float) -> dict:
+    """Busy seconds within [lo, hi] summed per key (port id, geo...)."""
+    clipped_starts, clipped_ends = clip(starts, ends, lo, hi)
+    unique_keys, inverse = np.unique(keys, return_inverse=True)
+    totals = np.bincount(inverse, weights=clipped_ends - clipped_starts, minlength=len(unique_keys))
+    return dict(zip(unique_keys.tolist(), totals.tolist()))
+
+
+def peak_concurrency_by_key(keys: np.ndarray, starts: np.ndarray, ends: np.ndarray) -> dict:
+    """
+    Maximum number of rents running at the same time per key: a sweep line over the start (+1) and end (-1) events
+    of all keys in one sort. A rent that ends exactly when another one starts is not counted as overlapping.
+    """
+    if not len(starts):
+        return {}
+
+    unique_keys, inverse = np.unique(keys, return_inverse=True)
+    groups = np.concatenate([inverse, inverse])
+    times = np.concatenate([starts, ends])
+    deltas = np.concatenate([np.ones(len(starts), dtype=np.int64), -np.ones(len(ends), dtype=np.int64)])
+
+    order = np.lexsort((deltas, times, groups))
+    # Every group's deltas add up to 0, so the running sum restarts from 0 at each group boundary
+    counts = np.cumsum(deltas[order])
+    group_starts = np.flatnonzero(np.r_[True, np.diff(groups[order]) != 0])
+    peaks = np.maximum.reduceat(counts, group_starts)
+    return dict(zip(unique_keys.tolist(), peaks.tolist()))
+
+
+def hold_time_percentiles(starts: np.ndarray, ends: np.ndarray, percentiles=(50, 90, 99)) -> dict:
+    if not len(starts):
+        return {percentile: 0.0 for percentile in percentiles}
+    return dict(zip(percentiles, np.percentile(ends - starts, percentiles).tolist()))
+
+
+def busy_time_by_hour(starts: np.ndarray, ends: np.ndarray, lo: float, hi: float):
+    """
+    Busy seconds in every hour from the hour containing `lo` up to `hi`. Returns (hour starts, busy seconds).
+    Uses the cumulative busy time B(t) = sum(clip(t - start, 0, end - start)), taken at the hour boundaries
+    with prefix sums, so intervals spanning many hours don't have to be split.
+    """
+    first_hour = np.floor(lo / 3600) * 3600
+    boundaries = np.arange(first_hour, hi + 3600, 3600)
+
+    # Relative times keep the prefix sums precise
+    sorted_starts = np.sort(starts) - first_hour
+    sorted_ends = np.sort(ends) - first_hour
+    points = boundaries - first_hour
+
+    start_sums = np.r_[0, np.cumsum(sorted_starts)]
+    end_sums = np.r_[0, np.cumsum(sorted_ends)]
+    started = np.searchsorted(sorted_starts, points)
+    ended = np.searchsorted(sorted_ends, points)
+    cumulative = (started * points - start_sums[started]) - (ended * points - end_sums[ended])
+
+    return boundaries[:-1], np.diff(cumulative)
+
+
+def weekly_heatmap(starts: np.ndarray, ends: np.ndarray, lo: float, hi: float) -> np.ndarray:
+    """Busy seconds as a 7 x 24 matrix, rows are weekdays (Monday first), columns are UTC hours."""
+    hours, busy = busy_time_by_hour(*clip(starts, ends, lo, hi), lo, hi)
+    # 1970-01-01 was a Thursday
+    weekdays = ((hours // 86400).astype(np.int64) + 3) % 7
+    hours_of_day = ((hours % 86400) // 3600).astype(np.int64)
+
+    heatmap = np.zeros((7, 24))
+    np.add.at(heatmap, (weekdays, hours_of_day), busy)
+    return heatmap
+
+
+if __name__ == '__main__':
+    # Benchmark on synthetic rents: python -m database.analytics
+    import time
+
+    rng = np.random.default_rng(0)
+    count = 1_000_000
+    month = 30 * 86400
+    starts = 1_700_000_000 + rng.uniform(0, month, count)
+    ends = starts + rng.exponential(600, count)
+    port_ids = rng.integers(1, 2001, count)
+    geos = rng.choice(np.array(['ua', 'pl', 'de']), count)
+    lo, hi = 1_700_000_000 + 86400, 1_700_000_000 + month - 86400
+
+    for name, run in [
+        ('busy time per port', lambda: busy_time_by_key(port_ids, starts, ends, lo, hi)),
+        ('peak concurrency per geo', lambda: peak_concurrency_by_key(geos, starts, ends)),
+        ('hold time percentiles', lambda: hold_time_percentiles(starts, ends)),
+        ('weekly heatmap', lambda: weekly_heatmap(starts, ends, lo, hi)),
+    ]:
+        started_at = time.perf_counter()
+        run()
+        print(f"{name}: {time.perf_counter() - started_at:.3f} s for {count} intervals")
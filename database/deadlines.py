@@ -0,0 +1,99 @@
+import asyncio
+import heapq
+import time
+from datetime import datetime, timezone
+
+from sqlalchemy import select
+
+from database.enums import ResponseStatus
+from database.models import PortResponses, Responses
+from database.session import SessionLocal
+
+
+def _to_timestamp(end_timestamp_utc: datetime) -> float:
+    # SQLite hands back naive datetimes, they are UTC like everything stored by the app
+    if end_timestamp_utc.tzinfo is None:
+        end_timestamp_utc = end_timestamp_utc.replace(tzinfo=timezone.utc)
+    return end_timestamp_utc.timestamp()
+
+
+class DeadlineScheduler:
+    """
+    Every port response ends at its end_timestamp_utc: PORT_WAITING responses are 60 second holds,
+    the rest are rents. Deadlines are keyed by response id and kept in one min-heap, rescheduling a response
+    replaces its previous deadline.
+    """
+
+    def __init__(self):
+        self._heap: list[tuple[float, int]] = []
+        self._deadlines: dict[int, tuple[float, ResponseStatus]] = {}
+        self._wakeup = asyncio.Event()
+        self._running: set[asyncio.Task] = set()
+
+    async def rebuild(self):
+        async with SessionLocal() as session:
+            result = await session.execute(
+                select(PortResponses.response_id, PortResponses.end_timestamp_utc, Responses.status)
+                .join(Responses)
+            )
+            rows = result.all()
+
+        self._heap = []
+        self._deadlines = {}
+        for response_id, end_timestamp_utc, status in rows:
+            self.schedule(response_id, end_timestamp_utc, status)
+
+    def schedule(self, response_id: int, end_timestamp_utc: datetime, status: ResponseStatus):
+        timestamp = _to_timestamp(end_timestamp_utc)
+        self._deadlines[response_id] = (timestamp, status)
+        heapq.heappush(self._heap, (timestamp, response_id))
+        self._wakeup.set()
+
+    def cancel(self, response_id: int):
+        # The heap entry stays and is skipped when it comes up
+        self._deadlines.pop(response_id, None)
+
+    def _next_delay(self) -> float | None:
+        while self._heap:
+            timestamp, response_id = self._heap[0]
+            deadline = self._deadlines.get(response_id)
+            if deadline and deadline[0] == timestamp:
+                return timestamp - time.time()
+            heapq.heappop(self._heap)
+        return None
+
+    async def run(self, handler):
+        """Call `handler(response_id, status)` for every deadline as soon as it passes, runs for the app lifetime."""
+        while True:
+            self._wakeup.clear()
+            delay = self._next_delay()
+
+            if delay is None:
+                await self._wakeup.wait()
+                continue
+
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            _, response_id = heapq.heappop(self._heap)
+            _, status = self._deadlines.pop(response_id)
+            task = asyncio.create_task(self._fire(handler, response_id, status))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    @staticmethod
+    async def _fire(handler, response_id: int, status: ResponseStatus):
+        try:
+            await handler(response_id, status)
+        except Exception as e:
+            print(f"Deadline for response {response_id} failed: {e}")
+
+    def __len__(self):
+        return len(self._deadlines)
+
+
+deadlines = DeadlineScheduler()
@@ -0,0 +1,26 @@
+from sqlalchemy import select
+
+from database.models import Operators, Cities
+from database.session import SessionLocal
+
+
+class DimensionCache:
+    """
+    Ids of operators and cities. Rows are never deleted, so a cached id stays valid;
+    ids are only cached after the transaction that created them has committed.
+    """
+
+    def __init__(self):
+        self.operators: dict[str, int] = {}
+        self.cities: dict[tuple[str, str], int] = {}
+
+    async def rebuild(self):
+        async with SessionLocal() as session:
+            operators = (await session.execute(select(Operators.operator, Operators.operator_id))).all()
+            cities = (await session.execute(select(Cities.city, Cities.region, Cities.city_id))).all()
+
+        self.operators = {operator: operator_id for operator, operator_id in operators}
+        self.cities = {(city, region): city_id for city, region, city_id in cities}
+
+
+dimensions = DimensionCache()
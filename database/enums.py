@@ -3,7 +3,7 @@ import enum
 
 class RequestStatus(enum.Enum):
     SUCCESS = 'Successfully served'
-    WAITING_FOR_PORT = 'Waiting for port (searching every 5 sec)'
+    WAITING_FOR_PORT = 'Waiting for port (served as soon as one is freed)'
     PORT_WAITING = 'Port is waiting 1 min'
     MISSED = 'Missed (no request for 1 min)'
     FINISHED = 'After successful /endport'
@@ -12,7 +12,7 @@ class RequestStatus(enum.Enum):
 
 class ResponseStatus(enum.Enum):
     SUCCESS = 'Successfully served'
-    PORT_WAITING = 'Port is waiting 1 min (searching every 5 sec)'
+    PORT_WAITING = 'Port is waiting 1 min'
     MISSED = 'Missed (no request for 1 min)'
     FINISHED = 'After successful /endport'
     AUTO_FINISHED = 'Auto finished after rent timeout, no /endport'
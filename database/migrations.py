@@ -0,0 +1,180 @@
+from datetime import datetime
+
+from sqlalchemy import select, insert, update, delete, func, inspect, text
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from database.enums import RequestStatus, ResponseStatus
+from database.models import Base, SchemaVersion, Ports, IPInfo, IPMetadata, SellerSyncs, PortUsageHourly, Requests, \
+    Responses, PortResponses
+from database.operations.usage_rollup import backfill_usage_rollup
+from database.session import engine, write_engine
+
+
+async def _initial_schema(conn: AsyncConnection):
+    # Same as the old create_tables(), existing tables are left untouched
+    await conn.run_sync(Base.metadata.create_all, checkfirst=True)
+
+
+def _latest_ip_info():
+    return (
+        select(IPInfo.ip_info_id)
+        .where(IPInfo.port_id == Ports.port_id)
+        .order_by(IPInfo.created_at.desc())
+        .limit(1)
+        .scalar_subquery()
+    )
+
+
+async def _current_ip_info(conn: AsyncConnection):
+    columns = await conn.run_sync(lambda sync_conn: inspect(sync_conn).get_columns('ports'))
+    if 'current_ip_info_id' not in [column['name'] for column in columns]:
+        await conn.execute(text('ALTER TABLE ports ADD COLUMN current_ip_info_id INTEGER REFERENCES ip_info(ip_info_id)'))
+
+    await conn.execute(
+        update(Ports)
+        .where(Ports.current_ip_info_id.is_(None))
+        .values(current_ip_info_id=_latest_ip_info())
+    )
+
+
+async def _create_indexes(conn: AsyncConnection, indexes: list[tuple[str, str, str, bool]]):
+    # Written out instead of taken from the models, so a migration creates the same indexes whenever it runs
+    for name, table, columns, unique in indexes:
+        await conn.execute(text(f'CREATE {"UNIQUE " if unique else ""}INDEX IF NOT EXISTS {name} ON {table} ({columns})'))
+
+
+async def _dedup_ports(conn: AsyncConnection):
+    """Merge ports synced twice under the same natural key into the oldest one, moving their history over."""
+    rows = (await conn.execute(
+        select(Ports.port_id, Ports.seller_id, Ports.host, Ports.socks_port, Ports.http_port).order_by(Ports.port_id)
+    )).all()
+
+    kept = {}
+    duplicates = []
+    for port_id, *natural_key in rows:
+        if None in natural_key:     # NULLs never collide in a unique index
+            continue
+        kept_port_id = kept.setdefault(tuple(natural_key), port_id)
+        if kept_port_id != port_id:
+            duplicates.append((port_id, kept_port_id))
+
+    for port_id, kept_port_id in duplicates:
+        await conn.execute(update(IPInfo).where(IPInfo.port_id == port_id).values(port_id=kept_port_id))
+        await conn.execute(update(PortResponses).where(PortResponses.port_id == port_id).values(port_id=kept_port_id))
+        await conn.execute(delete(Ports).where(Ports.port_id == port_id))
+
+    # The current IP Info of a merged port may have belonged to one of its duplicates
+    kept_port_ids = {kept_port_id for _, kept_port_id in duplicates}
+    if kept_port_ids:
+        await conn.execute(
+            update(Ports)
+            .where(Ports.port_id.in_(kept_port_ids))
+            .values(current_ip_info_id=_latest_ip_info())
+        )
+
+
+async def _dedup_port_responses(conn: AsyncConnection):
+    """Ports rented twice at once keep their latest rent, the others are finished."""
+    rows = (await conn.execute(
+        select(PortResponses.port_response_id, PortResponses.port_id, PortResponses.response_id)
+        .order_by(PortResponses.port_response_id.desc())
+    )).all()
+
+    seen_port_ids = set()
+    duplicates = []
+    for port_response_id, port_id, response_id in rows:
+        if port_id in seen_port_ids:
+            duplicates.append((port_response_id, response_id))
+        seen_port_ids.add(port_id)
+
+    if not duplicates:
+        return
+
+    response_ids = [response_id for _, response_id in duplicates]
+    await conn.execute(
+        update(Requests)
+        .where(Requests.request_id.in_(select(Responses.parent_request_id).where(Responses.response_id.in_(response_ids))))
+        .values(status=RequestStatus.AUTO_FINISHED)
+    )
+    await conn.execute(
+        update(Responses)
+        .where(Responses.response_id.in_(response_ids))
+        .values(status=ResponseStatus.AUTO_FINISHED, rent_ended_at=datetime.utcnow())
+    )
+    await conn.execute(
+        delete(PortResponses).where(PortResponses.port_response_id.in_([row[0] for row in duplicates]))
+    )
+
+
+async def _hot_path_indexes(conn: AsyncConnection):
+    # Unique indexes fail on existing duplicates (same port synced twice, two rents on one port), clean them up first
+    await _dedup_ports(conn)
+    await _dedup_port_responses(conn)
+    await _create_indexes(conn, [
+        ('ix_requests_pending', 'requests', 'login, servername, geo, ip_version, status', False),
+        ('ix_requests_status', 'requests', 'status', False),
+        ('ix_responses_parent_request_id', 'responses', 'parent_request_id', False),
+        ('uq_port_responses_port_id', 'port_responses', 'port_id', True),
+        ('ix_port_responses_response_id', 'port_responses', 'response_id', False),
+        ('ix_port_responses_end_timestamp_utc', 'port_responses', 'end_timestamp_utc', False),
+        ('ix_ip_info_port_id_created_at', 'ip_info', 'port_id, created_at', False),
+        ('uq_ports_natural_key', 'ports', 'seller_id, host, socks_port, http_port', True),
+        ('ix_ports_free_pool', 'ports', 'is_active, geo_id, ip_version', False),
+    ])
+
+
+async def _ip_metadata(conn: AsyncConnection):
+    await conn.run_sync(IPMetadata.__table__.create, checkfirst=True)
+
+
+async def _sync_fingerprint(conn: AsyncConnection):
+    columns = await conn.run_sync(lambda sync_conn: inspect(sync_conn).get_columns('ports'))
+    if 'sync_fingerprint' not in [column['name'] for column in columns]:
+        await conn.execute(text('ALTER TABLE ports ADD COLUMN sync_fingerprint TEXT'))
+
+
+async def _seller_syncs(conn: AsyncConnection):
+    await conn.run_sync(SellerSyncs.__table__.create, checkfirst=True)
+
+
+async def _port_usage_hourly(conn: AsyncConnection):
+    await conn.run_sync(PortUsageHourly.__table__.create, checkfirst=True)
+    await backfill_usage_rollup(conn)
+
+
+async def _requests_created_at_index(conn: AsyncConnection):
+    await _create_indexes(conn, [('ix_requests_created_at', 'requests', 'created_at', False)])
+
+
+MIGRATIONS = [
+    (1, 'initial schema', _initial_schema),
+    (2, 'ports.current_ip_info_id', _current_ip_info),
+    (3, 'hot path indexes', _hot_path_indexes),
+    (4, 'ip_metadata cache', _ip_metadata),
+    (5, 'ports.sync_fingerprint', _sync_fingerprint),
+    (6, 'seller_syncs', _seller_syncs),
+    (7, 'port_usage_hourly rollup', _port_usage_hourly),
+    (8, 'requests.created_at index', _requests_created_at_index),
+]
+
+
+async def migrate():
+    """Apply every migration newer than the version stored in schema_version, all in one transaction."""
+    # On SQLite the write engine emits BEGIN IMMEDIATE itself, the driver alone would commit DDL that runs before
+    # the first insert or update right away
+    async with (write_engine or engine).begin() as conn:
+        await conn.run_sync(SchemaVersion.__table__.create, checkfirst=True)
+        current_version = (await conn.execute(select(func.max(SchemaVersion.version)))).scalar() or 0
+
+        for version, name, migration in MIGRATIONS:
+            if version <= current_version:
+                continue
+
+            print(f"Applying migration {version}: {name}")
+            await migration(conn)
+            await conn.execute(insert(SchemaVersion).values(version=version, name=name))
+
+
+if __name__ == '__main__':
+    import asyncio
+    asyncio.run(migrate())
@@ -1,10 +1,21 @@
-from sqlalchemy import Column, Integer, ForeignKey, Boolean, DateTime, func, Text, select, insert, update, Enum, UniqueConstraint
+from sqlalchemy import Column, Integer, Float, ForeignKey, Boolean, DateTime, func, Text, select, insert, update, Enum, UniqueConstraint, Index
 from sqlalchemy.orm import relationship, declarative_base
 
 from database.enums import RequestStatus, ResponseStatus, RotationType
 
 Base = declarative_base()
 
+####################
+# Schema migration #
+####################
+
+class SchemaVersion(Base):
+    __tablename__ = 'schema_version'
+
+    version = Column(Integer, primary_key=True)
+    name = Column(Text, nullable=False)
+    applied_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+
 ################
 # User storage #
 ################
@@ -26,6 +37,19 @@ class SyncStatus(Base):
 
     sync_on = Column(Boolean, primary_key=True, nullable=False, default=False)
 
+
+class SellerSyncs(Base):
+    __tablename__ = 'seller_syncs'
+
+    seller_sync_id = Column(Integer, primary_key=True, autoincrement=True)
+    seller_id = Column(Integer, ForeignKey('sellers.seller_id', ondelete='CASCADE'))
+    started_at = Column(DateTime(timezone=True), nullable=False)
+    duration = Column(Float, nullable=False)    # Seconds
+    summary = Column(Text)
+    error = Column(Text)
+
+    __table_args__ = (Index('ix_seller_syncs_seller_id_started_at', 'seller_id', 'started_at'),)
+
 #################
 # Proxy related #
 #################
@@ -77,13 +101,21 @@ class Ports(Base):
     rotation_type = Column(Enum(RotationType))
     rotation_link = Column(Text)
     seller_id = Column(Integer, ForeignKey('sellers.seller_id'))
+    current_ip_info_id = Column(Integer, ForeignKey('ip_info.ip_info_id', use_alter=True))    # Latest IPInfo row
+    sync_fingerprint = Column(Text)     # Hash of the record last written by seller sync
 
     proxy_type = relationship('ProxyTypes', back_populates='ports')
     geo = relationship('Geos', back_populates='ports')
     seller = relationship('Sellers', back_populates='ports')
-    ip_info = relationship('IPInfo', back_populates='port')
+    ip_info = relationship('IPInfo', back_populates='port', foreign_keys='IPInfo.port_id')
+    current_ip_info = relationship('IPInfo', foreign_keys=[current_ip_info_id], post_update=True)
     port_response = relationship('PortResponses', back_populates='port')
 
+    __table_args__ = (
+        Index('uq_ports_natural_key', 'seller_id', 'host', 'socks_port', 'http_port', unique=True),
+        Index('ix_ports_free_pool', 'is_active', 'geo_id', 'ip_version'),
+    )
+
 
 class Requests(Base):
     __tablename__ = 'requests'
@@ -100,6 +132,12 @@ class Requests(Base):
 
     response = relationship('Responses', back_populates='parent_request')
 
+    __table_args__ = (
+        Index('ix_requests_pending', 'login', 'servername', 'geo', 'ip_version', 'status'),
+        Index('ix_requests_status', 'status'),
+        Index('ix_requests_created_at', 'created_at'),
+    )
+
 
 class Responses(Base):
     __tablename__ = 'responses'
@@ -115,6 +153,8 @@ class Responses(Base):
     ip_info = relationship('IPInfo', back_populates='response')
     port_response = relationship('PortResponses', back_populates='response')
 
+    __table_args__ = (Index('ix_responses_parent_request_id', 'parent_request_id'),)
+
 
 class Operators(Base):
     __tablename__ = 'operators'
@@ -149,10 +189,12 @@ class IPInfo(Base):
     city_id = Column(Integer, ForeignKey('cities.city_id'))
 
     response = relationship('Responses', back_populates='ip_info')
-    port = relationship('Ports', back_populates='ip_info')
+    port = relationship('Ports', back_populates='ip_info', foreign_keys=[port_id])
     operator = relationship('Operators', back_populates='ip_infos')
     city = relationship('Cities', back_populates='ip_infos')
 
+    __table_args__ = (Index('ix_ip_info_port_id_created_at', 'port_id', 'created_at'),)
+
 
 class PortResponses(Base):
     __tablename__ = 'port_responses'
@@ -165,15 +207,31 @@ class PortResponses(Base):
     port = relationship('Ports', back_populates='port_response')
     response = relationship('Responses', back_populates='port_response')
 
+    __table_args__ = (
+        Index('uq_port_responses_port_id', 'port_id', unique=True),     # One rent or hold per port at a time
+        Index('ix_port_responses_response_id', 'response_id'),
+        Index('ix_port_responses_end_timestamp_utc', 'end_timestamp_utc'),
+    )
+
+
+class IPMetadata(Base):
+    __tablename__ = 'ip_metadata'
+
+    key = Column(Text, primary_key=True)    # IP address, or its /24 (/64 for IPv6) network
+    city = Column(Text)
+    region = Column(Text)
+    org = Column(Text)
+    fetched_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+
 
-async def create_tables():
-    from sqlalchemy.ext.asyncio import create_async_engine
-    engine = create_async_engine('sqlite+aiosqlite:///../proxy.sqlite', echo=True)
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+class PortUsageHourly(Base):
+    """Closed rents rolled up per port, UTC hour and client. Filled when a rent ends, see operations.usage_rollup."""
+    __tablename__ = 'port_usage_hourly'
 
+    port_id = Column(Integer, primary_key=True)
+    hour = Column(DateTime(timezone=True), primary_key=True)     # Start of the hour
+    login = Column(Text, primary_key=True)
+    busy_seconds = Column(Float, nullable=False, default=0)
+    rentals = Column(Integer, nullable=False, default=0)       # Rents that started in this hour
 
-#
-if __name__ == '__main__':
-    import asyncio
-    asyncio.run(create_tables())
\ No newline at end of file
+    __table_args__ = (Index('ix_port_usage_hourly_hour', 'hour'),)
@@ -1,191 +1,301 @@
+from dataclasses import dataclass
 from datetime import timedelta, datetime
 
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select, insert, update, delete, or_, func, exists, and_
-from sqlalchemy.dialects.sqlite import insert as upsert_insert
+from sqlalchemy.orm import joinedload
 
 from database import models
-from database.session import SessionLocal
-from api.schemas.port import PortRequest
+from database.session import SessionLocal, upsert_insert, write_transaction
+from database.port_index import free_ports
+from database.deadlines import deadlines
+from database.dimensions import dimensions
+from database.operations.usage_rollup import add_rent_to_rollup
+from database.waiting_queue import waiting_queue, Waiter
+from api.schemas.port import PortRequest, PortsRequest
 from database.enums import RequestStatus, ResponseStatus
 
 
-async def write_request(session: AsyncSession, request: PortRequest, requester_login: str):
-    async with session:
-        result = await session.execute(insert(models.Requests).values(
-            servername=request.servername,
-            priority=request.priority,
-            geo=request.geo,
-            ip_version=request.ip_version,
-            rent_time=request.rent_time,
-            login=requester_login
-
-        ).returning(models.Requests.request_id))
-        await session.commit()
-        return result.scalars().first()
+@dataclass
+class AllocationResult:
+    port: models.Ports | None = None
+    ip_info: models.IPInfo | None = None
+    end_timestamp_utc: datetime | None = None
+    response_id: int | None = None
+    request_id: int | None = None
+    request_status: RequestStatus | None = None
 
+    @property
+    def success(self) -> bool:
+        return self.port is not None
 
-async def is_same_request(request: PortRequest, requester_login: str):
-    async with SessionLocal() as session:
-        result = await session.execute(
-            select(models.Requests.request_id)
-            .where(models.Requests.servername == request.servername)  # type: ignore
-            .where(models.Requests.login == requester_login)           # type: ignore
-            .where(models.Requests.geo == request.geo)                # type: ignore
-            .where(models.Requests.ip_version == request.ip_version)  # type: ignore
-            .where(or_(models.Requests.status == RequestStatus.WAITING_FOR_PORT, models.Requests.status == RequestStatus.PORT_WAITING))
-            .order_by(models.Requests.created_at.desc())
-            .limit(1)
-        )
-
-        return result.scalar()
 
+async def _lock_free_ports(session: AsyncSession, geo: str, ip_version: int, count: int):
+    # Ports come from the in-memory index, candidates are re-checked here in case the index is stale
+    locked = []
+    while len(locked) < count:
+        candidate_ids = []
+        while len(candidate_ids) < count - len(locked):
+            port_id = free_ports.claim(geo, ip_version)
+            if port_id is None:
+                break
+            candidate_ids.append(port_id)
 
-async def allocate_port(session: AsyncSession, request: PortRequest, request_id: int):
-    async with session.begin():
-        # Step 1: Find and Lock a Free Port
-        port_subquery = (
-            select(models.PortResponses.port_id)
-            .subquery()
-        )
+        if not candidate_ids:
+            break
 
         port_query = (
-            select(models.Ports)
-            .options()
-            .join(models.Geos)
+            select(models.Ports, models.IPInfo)
+            .outerjoin(models.IPInfo, models.IPInfo.ip_info_id == models.Ports.current_ip_info_id)
+            .options(joinedload(models.IPInfo.city), joinedload(models.IPInfo.operator))
+            .where(models.Ports.port_id.in_(candidate_ids))
             .where(models.Ports.is_active.is_(True))
-            .where(models.Geos.name == request.geo)                                                       # type: ignore
-            .where(models.Ports.ip_version == request.ip_version if request.ip_version != 0 else True)
-            .where(models.Ports.port_id.notin_(port_subquery))
-            # .with_for_update(skip_locked=True)  # Skip ports locked by other transactions
-            .limit(1)
+            .where(~exists().where(models.PortResponses.port_id == models.Ports.port_id))
+            .with_for_update(skip_locked=True, of=models.Ports)  # Skip ports locked by other transactions
         )
+        for port, ip_info in (await session.execute(port_query)).all():
+            if ip_info:
+                locked.append((port, ip_info))
+            else:
+                free_ports.remove(port.port_id)
 
-        port_result = await session.execute(port_query)
-        port = port_result.scalar_one_or_none()
-        # port = port_result.scalars().first()
+    return locked
 
-        if not port:
-            return None, None, None
-
-        # Step 2: Get Latest IP Info
-        ip_info_query = (
-            select(models.IPInfo)
-            .where(models.IPInfo.port_id == port.port_id)
-            .order_by(models.IPInfo.created_at.desc())
-            .limit(1)
-        )
 
-        ip_info_result = await session.execute(ip_info_query)
-        ip_info = ip_info_result.scalar_one_or_none()
+async def _lock_free_port(session: AsyncSession, geo: str, ip_version: int):
+    locked = await _lock_free_ports(session, geo, ip_version, 1)
+    return locked[0] if locked else (None, None)
 
-        if not ip_info:
-            return None, None, None
-
-        # Step 3: Update Request Status
-        await session.execute(
-            update(models.Requests)
-            .where(models.Requests.request_id == request_id)         # type: ignore
-            .values(status=RequestStatus.SUCCESS)
-        )
 
-        # Step 4: Create Response
-        response_insert = insert(models.Responses).values(
+async def _create_port_response(session: AsyncSession, request_id: int, port_id: int, ip_info_id: int,
+                                status: ResponseStatus, hold_seconds: int):
+    response_result = await session.execute(
+        insert(models.Responses).values(
             parent_request_id=request_id,
-            ip_info_id=ip_info.ip_info_id,
-            status=ResponseStatus.SUCCESS
+            ip_info_id=ip_info_id,
+            status=status
         ).returning(models.Responses.response_id, models.Responses.created_at)
+    )
+    response_id, created_at = response_result.first()
 
-        response_result = await session.execute(response_insert)
-        response_id, created_at = response_result.first()
-
-        # Step 5: Create Port Response
-        port_response_insert = insert(models.PortResponses).values(
+    port_response_result = await session.execute(
+        insert(models.PortResponses).values(
             response_id=response_id,
-            port_id=port.port_id,
-            end_timestamp_utc=created_at + timedelta(seconds=request.rent_time)
-        ).returning(models.PortResponses.end_timestamp_utc)
-
-        port_response_result = await session.execute(port_response_insert)
-        end_timestamp_utc = port_response_result.scalar()
-
-        return port, end_timestamp_utc, response_id
-
-
-async def is_waiting_for_port(session: AsyncSession, client_login: str, request: PortRequest):
-    async with session:
-        result = await session.execute(
-            select(models.Requests)
-            .where(models.Requests.login == client_login)             # type: ignore
-            .where(models.Requests.status == RequestStatus.WAITING_FOR_PORT)
-            .where(models.Requests.geo == request.geo)                # type: ignore
-            .where(models.Requests.ip_version == request.ip_version)  # type: ignore
+            port_id=port_id,
+            end_timestamp_utc=created_at + timedelta(seconds=hold_seconds)
+        ).returning(models.PortResponses.port_response_id, models.PortResponses.end_timestamp_utc)
+    )
+    port_response_id, end_timestamp_utc = port_response_result.first()
+
+    return response_id, port_response_id, end_timestamp_utc
+
+
+async def _give_waiting_port(session: AsyncSession, request_id: int, new_rent_time: int):
+    waiting_query = await session.execute(
+        select(models.PortResponses, models.Ports, models.IPInfo)
+        .select_from(models.PortResponses)
+        .join(models.Responses)
+        .join(models.Ports, models.Ports.port_id == models.PortResponses.port_id)
+        .join(models.IPInfo, models.IPInfo.ip_info_id == models.Responses.ip_info_id)
+        .options(joinedload(models.IPInfo.city), joinedload(models.IPInfo.operator))
+        .where(models.Responses.parent_request_id == request_id)
+        .where(models.Responses.status == ResponseStatus.PORT_WAITING)
+        .with_for_update(skip_locked=True, of=models.PortResponses)
+        .limit(1)
+    )
+    row = waiting_query.first()
+    if not row:
+        return AllocationResult(request_id=request_id, request_status=RequestStatus.PORT_WAITING)
+
+    port_response, port, ip_info = row
+    update_timeout = await session.execute(
+        update(models.PortResponses)
+        .where(models.PortResponses.port_response_id == port_response.port_response_id)
+        .values(end_timestamp_utc=datetime.utcnow() + timedelta(seconds=new_rent_time))
+        .returning(models.PortResponses.end_timestamp_utc)
+    )
+    end_time = update_timeout.scalar()
+
+    await session.execute(
+        update(models.Responses)
+        .where(models.Responses.response_id == port_response.response_id)
+        .values(status=ResponseStatus.SUCCESS)
+    )
+
+    await session.execute(
+        update(models.Requests)
+        .where(models.Requests.request_id == request_id)
+        .values(status=RequestStatus.SUCCESS)
+    )
+
+    return AllocationResult(port, ip_info, end_time, port_response.response_id, request_id, RequestStatus.SUCCESS)
+
+
+async def _lock_request_key(session: AsyncSession, request: PortRequest, requester_login: str):
+    # SQLite transactions already run one at a time through the single writer. On Postgres two transactions
+    # of one client could both miss the pending request and record it twice, so they take a lock per request key
+    if session.bind.dialect.name != 'postgresql':
+        return
+
+    key = f'{requester_login}|{request.servername}|{request.geo}|{request.ip_version}'
+    await session.execute(select(func.pg_advisory_xact_lock(func.hashtextextended(key, 0))))
+
+
+async def request_port(session: AsyncSession, request: PortRequest, requester_login: str) -> AllocationResult:
+    """
+    Serves /getport in one transaction: repeated request lookup, request recording, port claim
+    and the waiting fallback. Long-polled requests (request.wait > 0) always wait for a port and are watched
+    in the waiting queue.
+    """
+    port = None
+    waiter = None
+    watch = False
+
+    async def transaction(session: AsyncSession):
+        nonlocal port, waiter, watch
+
+        # Step 1: Look for pending requests of this client (same servername is a repeated request)
+        await _lock_request_key(session, request, requester_login)
+        pending_query = await session.execute(
+            select(models.Requests.request_id, models.Requests.servername, models.Requests.status)
+            .where(models.Requests.login == requester_login)            # type: ignore
+            .where(models.Requests.geo == request.geo)                  # type: ignore
+            .where(models.Requests.ip_version == request.ip_version)    # type: ignore
+            .where(or_(models.Requests.status == RequestStatus.WAITING_FOR_PORT,
+                       models.Requests.status == RequestStatus.PORT_WAITING))
+            .order_by(models.Requests.created_at.desc())
         )
-        return result.scalars().first() is not None
+        pending = pending_query.all()
+        same_request = next((row for row in pending if row.servername == request.servername), None)
+
+        if same_request and same_request.status == RequestStatus.PORT_WAITING:
+            return await _give_waiting_port(session, same_request.request_id, request.rent_time)
+
+        # Step 2: Claim a Free Port
+        port, ip_info = await _lock_free_port(session, request.geo, request.ip_version)
+
+        # Step 3: Record the Request (or reuse the one that is already waiting)
+        if same_request:
+            request_id = same_request.request_id
+            if not port and request.wait:
+                watch = True
+            elif port:
+                await session.execute(
+                    update(models.Requests)
+                    .where(models.Requests.request_id == request_id)
+                    .values(status=RequestStatus.SUCCESS)
+                )
+        else:
+            if port:
+                status = RequestStatus.SUCCESS
+            elif request.wait or not any(row.status == RequestStatus.WAITING_FOR_PORT for row in pending):
+                status = RequestStatus.WAITING_FOR_PORT
+            else:
+                status = None
+
+            request_result = await session.execute(
+                insert(models.Requests).values(
+                    servername=request.servername,
+                    priority=request.priority,
+                    geo=request.geo,
+                    ip_version=request.ip_version,
+                    rent_time=request.rent_time,
+                    login=requester_login,
+                    status=status
+                ).returning(models.Requests.request_id, models.Requests.created_at)
+            )
+            request_id, created_at = request_result.first()
 
+            if status == RequestStatus.WAITING_FOR_PORT:
+                watch = bool(request.wait)
+                waiter = Waiter(request_id, request.geo, request.ip_version, request.priority, created_at)
 
-async def set_waiting_for_port(session: AsyncSession, request_id: int):
-    async with session:
-        await session.execute(
-            update(models.Requests)
-            .where(models.Requests.request_id == request_id)
-            .values(status=RequestStatus.WAITING_FOR_PORT)
-        )
-        await session.commit()
-
+        if not port:
+            return AllocationResult(request_id=request_id, request_status=same_request.status if same_request else status)
 
-async def give_port_if_found(session: AsyncSession, request_id: int, new_rent_time: int):
-    async with session.begin():
-        response_id_subquery = (
-            select(models.Responses.response_id)
-            .where(models.Responses.parent_request_id == request_id)
-            .scalar_subquery()
+        # Step 4: Create Response and Port Response
+        response_id, _, end_timestamp_utc = await _create_port_response(
+            session, request_id, port.port_id, ip_info.ip_info_id, ResponseStatus.SUCCESS, request.rent_time
         )
 
-        target_port_response = await session.execute(
-            select(models.PortResponses)
-            .join(models.Responses)
-            .where(models.Responses.response_id == response_id_subquery)
-            .where(models.Responses.status == ResponseStatus.PORT_WAITING)
-            .with_for_update(skip_locked=True)
-            .limit(1)
+        return AllocationResult(port, ip_info, end_timestamp_utc, response_id, request_id, RequestStatus.SUCCESS)
+
+    try:
+        result = await write_transaction(transaction, session)
+    except Exception:
+        if port:
+            free_ports.release(port.port_id)
+        raise
+
+    # Only once committed: a waiter served before that would find no waiting request to update
+    if watch:
+        waiting_queue.watch(result.request_id)
+    if waiter:
+        waiting_queue.push(waiter)
+
+    if result.success:
+        deadlines.schedule(result.response_id, result.end_timestamp_utc, ResponseStatus.SUCCESS)
+    return result
+
+
+async def request_ports(session: AsyncSession, request: PortsRequest, count: int,
+                        requester_login: str) -> list[AllocationResult]:
+    """
+    Lease up to `count` ports for one client in a single transaction. Every leased port gets its own request,
+    response and port response, so each order can be ended separately. Requests that can't be served are not recorded.
+    """
+    locked = []
+
+    async def transaction(session: AsyncSession):
+        nonlocal locked
+
+        # Step 1: Claim up to `count` Free Ports with their Latest IP Info
+        locked = await _lock_free_ports(session, request.geo, request.ip_version, count)
+        if not locked:
+            return []
+
+        # Step 2: Record one Request per Port
+        request_result = await session.execute(
+            insert(models.Requests).returning(models.Requests.request_id, sort_by_parameter_order=True),
+            [dict(servername=request.servername, priority=request.priority, geo=request.geo,
+                  ip_version=request.ip_version, rent_time=request.rent_time, login=requester_login,
+                  status=RequestStatus.SUCCESS) for _ in locked]
         )
-
-        port_response = target_port_response.scalar_one_or_none()
-        if not port_response:
-            return None, None, None
-
-
-        update_timeout = await session.execute(
-            update(models.PortResponses)
-            .where(models.PortResponses.port_response_id == port_response.port_response_id)
-            .values(end_timestamp_utc=datetime.utcnow() + timedelta(seconds=new_rent_time))
-            .returning(models.PortResponses.end_timestamp_utc)
+        request_ids = request_result.scalars().all()
+
+        # Step 3: Create Responses
+        response_result = await session.execute(
+            insert(models.Responses).returning(models.Responses.response_id, models.Responses.created_at,
+                                               sort_by_parameter_order=True),
+            [dict(parent_request_id=request_id, ip_info_id=ip_info.ip_info_id, status=ResponseStatus.SUCCESS)
+             for request_id, (_, ip_info) in zip(request_ids, locked)]
         )
+        responses = response_result.all()
 
-        end_time = update_timeout.scalar()
+        # Step 4: Create Port Responses
+        results = []
+        port_responses = []
+        for request_id, (port, ip_info), (response_id, created_at) in zip(request_ids, locked, responses):
+            end_timestamp_utc = created_at + timedelta(seconds=request.rent_time)
+            port_responses.append(dict(response_id=response_id, port_id=port.port_id,
+                                       end_timestamp_utc=end_timestamp_utc))
+            results.append(AllocationResult(port, ip_info, end_timestamp_utc, response_id, request_id,
+                                            RequestStatus.SUCCESS))
 
-        port_query = await session.execute(
-            select(models.Ports)
-            .where(models.Ports.port_id == port_response.port_id)
-        )
-        port = port_query.scalar_one_or_none()
+        await session.execute(insert(models.PortResponses), port_responses)
 
-        response_update = await session.execute(
-            update(models.Responses)
-            .where(models.Responses.response_id == response_id_subquery)
-            .values(status=ResponseStatus.SUCCESS)
-            .returning(models.Responses.response_id)
-        )
-        response_id = response_update.scalar()
+        return results
 
-        await session.execute(
-            update(models.Requests)
-            .where(models.Requests.request_id == request_id)
-            .values(status=RequestStatus.SUCCESS)
-        )
+    try:
+        results = await write_transaction(transaction, session)
+    except Exception:
+        for port, _ in locked:
+            free_ports.release(port.port_id)
+        raise
 
-        return port, end_time, response_id
+    for result in results:
+        deadlines.schedule(result.response_id, result.end_timestamp_utc, ResponseStatus.SUCCESS)
+    return results
 
 
 #####
@@ -217,25 +327,32 @@ async def check_rent_already_ended(session: AsyncSession, response_id: int):
         return True if result else False
 
 
-async def finish_request_and_response(response_id: int):
-    session = SessionLocal()
-    async with session.begin():
+async def finish_request_and_response(response_id: int, auto: bool = False) -> bool:
+    """Close the rent, returns False if it was already closed (a second /endport or the deadline came first)."""
+    async def transaction(session: AsyncSession):
         update_response = await session.execute(
             update(models.Responses)
             .where(models.Responses.response_id == response_id)
-            .values(status=ResponseStatus.FINISHED,
+            .where(models.Responses.rent_ended_at.is_(None))
+            .values(status=ResponseStatus.AUTO_FINISHED if auto else ResponseStatus.FINISHED,
                     rent_ended_at=datetime.utcnow())
             .returning(models.Responses.parent_request_id)
         )
 
         parent_request_id = update_response.scalar()
+        if parent_request_id is None:
+            return False
 
         await session.execute(
             update(models.Requests)
             .where(models.Requests.request_id == parent_request_id)
-            .values(status=RequestStatus.FINISHED)
+            .values(status=RequestStatus.AUTO_FINISHED if auto else RequestStatus.FINISHED)
         )
-    await session.close()
+
+        await add_rent_to_rollup(session, response_id)
+        return True
+
+    return await write_transaction(transaction)
 
 
 async def get_port_for_rotation(response_id: int):
@@ -259,9 +376,16 @@ async def get_port_for_rotation(response_id: int):
 #         return result.scalar()
 
 
-async def create_new_ip_info(port_id: int, ip: str, ip_version: int, city: str, region: str, operator: str):
-    session = SessionLocal()
-    async with session.begin():
+async def insert_ip_info(session: AsyncSession, port_id: int, ip: str, ip_version: int, city: str, region: str,
+                         operator: str):
+    """
+    Insert a new IPInfo row and make it the port's current one. Operators and cities are almost always cached,
+    then this is a single insert and update. Returns the operator and city ids, cache them once committed.
+    """
+    operator_id = dimensions.operators.get(operator)
+    city_id = dimensions.cities.get((city, region))
+
+    if operator_id is None:
         operator_stmt = (
             upsert_insert(models.Operators)
             .values(operator=operator)
@@ -271,6 +395,7 @@ async def create_new_ip_info(port_id: int, ip: str, ip_version: int, city: str,
         operator_result = await session.execute(operator_stmt)
         operator_id = operator_result.scalar()
 
+    if city_id is None:
         city_stmt = (
             upsert_insert(models.Cities)
             .values(city=city, region=region)
@@ -280,169 +405,165 @@ async def create_new_ip_info(port_id: int, ip: str, ip_version: int, city: str,
         city_result = await session.execute(city_stmt)
         city_id = city_result.scalar()
 
-        await session.execute(
-            insert(models.IPInfo).values(
-                port_id=port_id,
-                ip=ip,
-                ip_version=ip_version,
-                operator_id=operator_id,
-                city_id=city_id
-            )
-        )
-    await session.close()
+    ip_info_result = await session.execute(
+        insert(models.IPInfo).values(
+            port_id=port_id,
+            ip=ip,
+            ip_version=ip_version,
+            operator_id=operator_id,
+            city_id=city_id
+        ).returning(models.IPInfo.ip_info_id)
+    )
+
+    await session.execute(
+        update(models.Ports)
+        .where(models.Ports.port_id == port_id)
+        .values(current_ip_info_id=ip_info_result.scalar())
+    )
+
+    return operator_id, city_id
+
+
+async def create_new_ip_info(port_id: int, ip: str, ip_version: int, city: str, region: str, operator: str):
+    operator_id, city_id = await write_transaction(
+        lambda session: insert_ip_info(session, port_id, ip, ip_version, city, region, operator)
+    )
+
+    dimensions.operators[operator] = operator_id
+    dimensions.cities[(city, region)] = city_id
 
 
 async def delete_port_response(response_id: int):
-    async with SessionLocal() as session:
-        await session.execute(
+    async def transaction(session: AsyncSession):
+        result = await session.execute(
             delete(models.PortResponses)
             .where(models.PortResponses.response_id == response_id)
+            .returning(models.PortResponses.port_id)
         )
+        return result.scalars().all()
 
-        await session.commit()
+    port_ids = await write_transaction(transaction)
 
+    for port_id in port_ids:
+        free_ports.release(port_id)
 
 
-######
-# Automatic utils
-######
 
-async def get_waiting_requests():
-    session = SessionLocal()
-    async with session:
+async def get_ip_metadata(keys: list[str], fetched_after: datetime):
+    async with SessionLocal() as session:
         result = await session.execute(
-            select(models.Requests)
-            .where(models.Requests.status == RequestStatus.WAITING_FOR_PORT)
+            select(models.IPMetadata)
+            .where(models.IPMetadata.key.in_(keys))
+            .where(models.IPMetadata.fetched_at >= fetched_after)
         )
-
         return result.scalars().all()
 
-async def check_waiting_requests(waiting_requests: list[models.Requests]):
-    session = SessionLocal()
-
-    # print("Checking for waiting requests...")
-    # waiting_requests = await session.execute(
-    #     select(models.Requests)
-    #     .where(models.Requests.status == RequestStatus.WAITING_FOR_PORT)        # type: ignore
-    #     .order_by(models.Requests.created_at.asc(), models.Requests.priority.desc())
-    # )
-    #
-    # waiting_requests = waiting_requests.scalars().all()
-
-    check_after_60_sec = []
-
-    for request in waiting_requests:
-        print(f"Processing request {request.request_id}")
-        async with session.begin():
-            # Step 1: Find and Lock a Free Port
-            port_subquery = (
-                select(models.PortResponses.port_id)
-                .subquery()
-            )
 
-            port_query = (
-                select(models.Ports.port_id)
-                .join(models.Geos)
-                .where(models.Ports.is_active.is_(True))
-                .where(models.Geos.name == request.geo)
-                .where(models.Ports.ip_version == request.ip_version if request.ip_version != 0 else True)
-                .where(models.Ports.port_id.notin_(port_subquery))
-                .with_for_update(skip_locked=True)  # Skip ports locked by other transactions
-                .limit(1)
-            )
-
-            port_result = await session.execute(port_query)
-            port_id = port_result.scalar_one_or_none()
+async def save_ip_metadata(rows: list[dict]):
+    stmt = upsert_insert(models.IPMetadata)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['key'],
+        set_=dict(city=stmt.excluded.city, region=stmt.excluded.region, org=stmt.excluded.org,
+                  fetched_at=stmt.excluded.fetched_at)
+    )
+    await write_transaction(lambda session: session.execute(stmt, rows))
 
-            if not port_id:
-                continue
 
-            # Step 2: Get Latest IP Info
-            ip_info_query = (
-                select(models.IPInfo)
-                .where(models.IPInfo.port_id == port_id)
-                .order_by(models.IPInfo.created_at.desc())
-                .limit(1)
-            )
+######
+# Automatic utils
+######
 
-            ip_info_result = await session.execute(ip_info_query)
-            ip_info = ip_info_result.scalar_one_or_none()
+async def assign_port_to_waiting_request(waiter: Waiter):
+    """
+    Hold a free port for a waiting request for 60 seconds.
+    Returns the response id, or None if the request was already served elsewhere.
+    The waiter is put back in the queue when no port was free or the transaction failed.
+    """
+    port_id = None
+    no_port = False
 
-            if not ip_info:
-                continue
+    async def transaction(session: AsyncSession):
+        nonlocal port_id, no_port
 
-            # Step 3: Update Request Status
-            await session.execute(
-                update(models.Requests)
-                .where(models.Requests.request_id == request.request_id)
-                .values(status=RequestStatus.PORT_WAITING)
-            )
+        # Step 1: Claim a Free Port and its Latest IP Info
+        port, ip_info = await _lock_free_port(session, waiter.geo, waiter.ip_version)
+        if not port:
+            no_port = True
+            return None
+        port_id = port.port_id
 
-            # Step 4: Create Response
-            response_insert = insert(models.Responses).values(
-                parent_request_id=request.request_id,
-                ip_info_id=ip_info.ip_info_id,
-                status=ResponseStatus.PORT_WAITING
-            ).returning(models.Responses.response_id, models.Responses.created_at)
+        # Step 2: Update Request Status if it's still waiting
+        request_update = await session.execute(
+            update(models.Requests)
+            .where(models.Requests.request_id == waiter.request_id)
+            .where(models.Requests.status == RequestStatus.WAITING_FOR_PORT)
+            .values(status=RequestStatus.PORT_WAITING)
+            .returning(models.Requests.request_id)
+        )
+        if not request_update.scalar():
+            free_ports.release(port_id)
+            return None
 
-            response_result = await session.execute(response_insert)
-            response_row = response_result.fetchone()
-            response_id, response_created_at = response_row
+        # Step 3: Create Response and Port Response
+        response_id, _, end_timestamp_utc = await _create_port_response(
+            session, waiter.request_id, port_id, ip_info.ip_info_id, ResponseStatus.PORT_WAITING, 60
+        )
+        return response_id, end_timestamp_utc
 
-            # Step 5: Create Port Response
-            port_response_insert = insert(models.PortResponses).values(
-                response_id=response_id,
-                port_id=port_id,
-                end_timestamp_utc=response_created_at + timedelta(seconds=60)
-            ).returning(models.PortResponses.port_response_id)
+    try:
+        hold = await write_transaction(transaction)
+    except Exception:
+        if port_id:
+            free_ports.release(port_id)
+        waiting_queue.push(waiter)
+        raise
 
-            port_response = await session.execute(port_response_insert)
-            check_after_60_sec.append(port_response.scalar())
+    if no_port:
+        waiting_queue.push(waiter)
+    if not hold:
+        return None
 
-    await session.close()
-    return check_after_60_sec
+    response_id, end_timestamp_utc = hold
+    deadlines.schedule(response_id, end_timestamp_utc, ResponseStatus.PORT_WAITING)
+    return response_id
 
 
-async def free_missed_port(port_response_id: int):
-    session = SessionLocal()
-    async with session.begin():
+async def free_missed_port(response_id: int):
+    async def transaction(session: AsyncSession):
         port_response = await session.execute(
-            select(models.PortResponses.port_response_id, models.PortResponses.response.id, models.Responses.parent_request_id)
+            select(models.PortResponses.port_response_id, models.PortResponses.port_id,
+                   models.Responses.parent_request_id)
             .join(models.Responses)
-            .where(models.PortResponses.port_response_id == port_response_id)
+            .where(models.PortResponses.response_id == response_id)
             .where(models.Responses.status == ResponseStatus.PORT_WAITING)
+            .with_for_update(skip_locked=True, of=models.PortResponses)
         )
         port_response = port_response.first()
+        if not port_response:
+            return None
 
-        if port_response:
-            port_response_id, response_id, request_id = port_response
-
-            await session.execute(
-                delete(models.PortResponses)
-                .where(models.PortResponses.port_response_id == port_response_id)
-            )
+        port_response_id, port_id, request_id = port_response
 
-            await session.execute(
-                update(models.Requests)
-                .where(models.Requests.request_id == request_id)
-                .values(status=RequestStatus.MISSED)
-            )
+        await session.execute(
+            delete(models.PortResponses)
+            .where(models.PortResponses.port_response_id == port_response_id)
+        )
 
-            await session.execute(
-                update(models.Responses)
-                .where(models.Responses.response_id == response_id)
-                .values(status=RequestStatus.MISSED)
-            )
+        await session.execute(
+            update(models.Requests)
+            .where(models.Requests.request_id == request_id)
+            .values(status=RequestStatus.MISSED)
+        )
 
-    await session.close()
+        await session.execute(
+            update(models.Responses)
+            .where(models.Responses.response_id == response_id)
+            .values(status=ResponseStatus.MISSED)
+        )
 
+        return port_id
 
-async def get_expired_responses():
-    async with SessionLocal() as session:
-        result = await session.execute(
-            select(models.Responses.response_id)
-            .join(models.PortResponses)
-            .where(models.PortResponses.end_timestamp_utc < datetime.utcnow())
-        )
+    port_id = await write_transaction(transaction)
+    if port_id:
+        free_ports.release(port_id)
 
-        return result.scalars().all()
@@ -2,11 +2,12 @@ import datetime
 from datetime import datetime
 
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, insert, delete, update, not_, func, or_, and_, case, bindparam
+from sqlalchemy import select, insert, delete, update, not_, func, or_, and_, case
 from sqlalchemy.orm import aliased
 
-from database.models import Ports, Sellers, Geos, ProxyTypes, Requests, Responses, PortResponses, IPInfo
-from database.session import SessionLocal, engine
+from database.models import Ports, Sellers, Geos, ProxyTypes, Requests, PortResponses, PortUsageHourly
+from database.session import SessionLocal, write_transaction
+from database.port_index import free_ports
 
 
 async def get_sellers():
@@ -23,14 +24,12 @@ async def get_seller(seller_id: int):
 
 
 async def add_seller(mark: str, login: str, password: str, site_link: str):
-    async with SessionLocal() as session:
-        query = insert(Sellers).values(mark=mark, login=login, password=password, site_link=site_link)
-        await session.execute(query)
-        await session.commit()
+    query = insert(Sellers).values(mark=mark, login=login, password=password, site_link=site_link)
+    await write_transaction(lambda session: session.execute(query))
 
 
 async def delete_seller(seller_id: int):
-    async with SessionLocal() as session:
+    async def transaction(session: AsyncSession):
         result = await session.execute(
             delete(Sellers).where(Sellers.seller_id == seller_id)
             .returning(Sellers.seller_id)
@@ -38,6 +37,8 @@ async def delete_seller(seller_id: int):
 
         return result.scalar()
 
+    return await write_transaction(transaction)
+
 
 async def get_ports():
     async with SessionLocal() as session:
@@ -54,22 +55,22 @@ async def get_port(port_id: int):
 
 
 async def add_port(data: dict):
-    async with SessionLocal() as session:
+    async def transaction(session: AsyncSession):
         res = await session.execute(insert(Ports).values(**data).returning(Ports.port_id))
-        await session.commit()
         return res.scalar()
 
+    return await write_transaction(transaction)
+
 
 async def add_port_ip_version(port_id: int, ip_version: int):
-    async with SessionLocal() as session:
-        await session.execute(update(Ports).where(Ports.port_id == port_id).values(ip_version=ip_version))
-        await session.commit()
+    query = update(Ports).where(Ports.port_id == port_id).values(ip_version=ip_version)
+    await write_transaction(lambda session: session.execute(query))
 
 
 async def delete_port(port_id: int):
-    async with SessionLocal() as session:
-        await session.execute(delete(Ports).where(Ports.port_id == port_id))
-        await session.commit()
+    query = delete(Ports).where(Ports.port_id == port_id)
+    await write_transaction(lambda session: session.execute(query))
+    free_ports.remove(port_id)
 
 async def get_sellers_ports(seller_id: int):
     async with SessionLocal() as session:
@@ -79,15 +80,19 @@ async def get_sellers_ports(seller_id: int):
 
 
 async def flip_port_status(port_id: int):
-    async with SessionLocal() as session:
+    async def transaction(session: AsyncSession):
         stmt = await session.execute(
             update(Ports)
             .where(Ports.port_id == port_id)
             .values(is_active=not_(Ports.is_active))
             .returning(Ports.is_active))
-        await session.commit()
         return stmt.scalar()
 
+    is_active = await write_transaction(transaction)
+
+    await free_ports.refresh([port_id])
+    return is_active
+
 
 
 async def get_geos():
@@ -105,38 +110,36 @@ async def get_proxy_types():
 
 
 async def add_geo(geo: str):
-    async with SessionLocal() as session:
-        await session.execute(insert(Geos).values(name=geo))
-        await session.commit()
+    await write_transaction(lambda session: session.execute(insert(Geos).values(name=geo)))
 
 
 async def add_proxy_type(proxy_type: str):
-    async with SessionLocal() as session:
-        await session.execute(insert(ProxyTypes).values(name=proxy_type))
-        await session.commit()
+    await write_transaction(lambda session: session.execute(insert(ProxyTypes).values(name=proxy_type)))
 
 
 async def delete_geo(geo_id: int):
-    async with SessionLocal() as session:
-        await session.execute(delete(Geos).where(Geos.geo_id == geo_id))
-        await session.commit()
+    await write_transaction(lambda session: session.execute(delete(Geos).where(Geos.geo_id == geo_id)))
 
 
 async def delete_proxy_type(proxy_type_id: int):
-    async with SessionLocal() as session:
-        await session.execute(delete(ProxyTypes).where(ProxyTypes.proxy_type_id == proxy_type_id))
-        await session.commit()
+    query = delete(ProxyTypes).where(ProxyTypes.proxy_type_id == proxy_type_id)
+    await write_transaction(lambda session: session.execute(query))
 
 
 async def count_requests(start_date: datetime, end_date: datetime):
+    """
+    Requests created within [start_date, end_date), counted per status, geo and login.
+    The raw created_at column is compared, so the range is served by ix_requests_created_at.
+    """
     async with SessionLocal() as session:
-        if start_date == end_date:
-            query = select(func.count(Requests.request_id)).where(func.DATE(Requests.created_at) == start_date)
-        else:
-            query = select(func.count(Requests.request_id)).where(func.DATE(Requests.created_at) >= start_date, func.DATE(Requests.created_at) <= end_date)
-
+        query = (
+            select(Requests.status, Requests.geo, Requests.login, func.count(Requests.request_id).label('requests'))
+            .where(Requests.created_at >= start_date)
+            .where(Requests.created_at < end_date)
+            .group_by(Requests.status, Requests.geo, Requests.login)
+        )
         result = await session.execute(query)
-        return result.scalar()
+        return result.all()
 
 
 async def get_rent_end_times():
@@ -156,7 +159,6 @@ async def get_busy_time_for_port(
     Asynchronously calculate the total busy time in seconds for a specific port within the specified UTC date range.
 
     Parameters:
-        session (AsyncSession): SQLAlchemy asynchronous session object.
         start_date (datetime.datetime): Start of the date range (inclusive). Must be timezone-aware UTC.
         end_date (datetime.datetime): End of the date range (exclusive). Must be timezone-aware UTC.
         port_id (int): The ID of the port for which to calculate the busy time.
@@ -165,51 +167,33 @@ async def get_busy_time_for_port(
         float: Total busy time in seconds for the specified port within the date range.
     """
 
-    async with SessionLocal() as session:
-        # Bind parameters
-        interval_start_param = bindparam('interval_start', value=start_date)
-        interval_end_param = bindparam('interval_end', value=end_date)
-        port_id_param = bindparam('port_id', value=port_id)
-
-        base_query = (
-            select(Responses, IPInfo)
-            .select_from(Responses)
-            .join(IPInfo, Responses.ip_info_id == IPInfo.ip_info_id)
-            .where(
-                IPInfo.port_id == port_id_param,
-                Responses.rent_ended_at.isnot(None),
-                Responses.rent_ended_at >= interval_start_param,
-                Responses.created_at <= interval_end_param,
-            )
-        )
-
-        if engine.name == 'sqlite':
-            # SQLite uses MAX and MIN instead of GREATEST and LEAST
-            overlap_start = func.max(Responses.created_at, interval_start_param)
-            overlap_end = func.min(Responses.rent_ended_at, interval_end_param)
-
-            duration_expr = (func.julianday(overlap_end) - func.julianday(overlap_start)) * 86400.0
-        else:
-            # PostgreSQL uses GREATEST and LEAST functions
-            overlap_start = func.greatest(Responses.created_at, interval_start_param)
-            overlap_end = func.least(Responses.rent_ended_at, interval_end_param)
-
-            duration_expr = func.extract('epoch', overlap_end - overlap_start)
+    usage = await get_port_usage(start_date, end_date, [port_id])
+    return usage[port_id].busy_seconds if port_id in usage else 0
 
-        # Sum the durations over all matching responses
-        total_busy_time_seconds = func.sum(duration_expr)
 
-        # Construct the final query
-        query = base_query.with_only_columns(total_busy_time_seconds)
+async def get_port_usage(
+    start_date: datetime,
+    end_date: datetime,
+    port_ids: list[int] | None = None
+) -> dict:
+    """
+    Busy seconds, rentals and distinct clients of every port (or only `port_ids`) from the hourly rollup.
+    Hours are counted whole: every hour that starts within [start_date, end_date) is included.
+    Ports that weren't rented are missing from the result.
+    """
 
-        result = await session.execute(
-            query,
-            {
-                'port_id': port_id,
-                'interval_start': start_date,
-                'interval_end': end_date,
-            },
+    async with SessionLocal() as session:
+        query = (
+            select(PortUsageHourly.port_id,
+                   func.sum(PortUsageHourly.busy_seconds).label('busy_seconds'),
+                   func.sum(PortUsageHourly.rentals).label('rentals'),
+                   func.count(func.distinct(PortUsageHourly.login)).label('clients'))
+            .where(PortUsageHourly.hour >= start_date.replace(minute=0, second=0, microsecond=0))
+            .where(PortUsageHourly.hour < end_date)
+            .group_by(PortUsageHourly.port_id)
         )
+        if port_ids is not None:
+            query = query.where(PortUsageHourly.port_id.in_(port_ids))
 
-        return result.scalar() or 0  # Handle None result
-
+        result = await session.execute(query)
+        return {row.port_id: row for row in result.all()}
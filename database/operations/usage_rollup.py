@@ -0,0 +1,94 @@
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import select, delete
+from sqlalchemy.ext.asyncio import AsyncSession, AsyncConnection
+
+from database.models import PortUsageHourly, Responses, Requests, IPInfo
+from database.session import upsert_insert
+
+
+def _naive_utc(value: datetime) -> datetime:
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def hour_buckets(start: datetime, end: datetime):
+    """Split [start, end) into (hour start, seconds) pieces."""
+    start, end = _naive_utc(start), _naive_utc(end)
+    hour = start.replace(minute=0, second=0, microsecond=0)
+    while hour < end:
+        next_hour = hour + timedelta(hours=1)
+        yield hour, (min(end, next_hour) - max(start, hour)).total_seconds()
+        hour = next_hour
+
+
+def rollup_rows(rents) -> list[dict]:
+    """Aggregate (port_id, login, created_at, rent_ended_at) rents into port_usage_hourly rows."""
+    rows = {}
+    for port_id, login, created_at, rent_ended_at in rents:
+        for number, (hour, seconds) in enumerate(hour_buckets(created_at, rent_ended_at)):
+            row = rows.setdefault((port_id, hour, login or ''), dict(port_id=port_id, hour=hour, login=login or '',
+                                                                      busy_seconds=0, rentals=0))
+            row['busy_seconds'] += seconds
+            row['rentals'] += number == 0
+    return list(rows.values())
+
+
+def _rents_query():
+    return (
+        select(Responses.response_id, IPInfo.port_id, Requests.login, Responses.created_at, Responses.rent_ended_at)
+        .select_from(Responses)
+        .join(Requests, Requests.request_id == Responses.parent_request_id)
+        .join(IPInfo, IPInfo.ip_info_id == Responses.ip_info_id)
+        .where(Responses.rent_ended_at.isnot(None))
+    )
+
+
+def _additive_upsert():
+    stmt = upsert_insert(PortUsageHourly)
+    return stmt.on_conflict_do_update(
+        index_elements=['port_id', 'hour', 'login'],
+        set_=dict(busy_seconds=PortUsageHourly.busy_seconds + stmt.excluded.busy_seconds,
+                  rentals=PortUsageHourly.rentals + stmt.excluded.rentals)
+    )
+
+
+async def add_rent_to_rollup(session: AsyncSession, response_id: int):
+    """Add a rent that was just closed, called inside the transaction that sets rent_ended_at."""
+    rents = (await session.execute(_rents_query().where(Responses.response_id == response_id))).all()
+    rows = rollup_rows(rent[1:] for rent in rents)
+    if not rows:
+        return
+
+    await session.execute(_additive_upsert(), rows)
+
+
+async def backfill_usage_rollup(conn: AsyncConnection):
+    """Rebuild port_usage_hourly from every closed rent in responses, 10000 rents at a time."""
+    await conn.execute(delete(PortUsageHourly))
+
+    # Pages by response_id instead of one streamed cursor: Postgres won't index a table with an open cursor on it
+    # in the same transaction, and the later migrations do
+    rents = 0
+    last_response_id = 0
+    while chunk := (await conn.execute(
+        _rents_query().where(Responses.response_id > last_response_id).order_by(Responses.response_id).limit(10000)
+    )).all():
+        # Hours shared with earlier chunks are added up by the upsert
+        await conn.execute(_additive_upsert(), rollup_rows(rent[1:] for rent in chunk))
+        rents += len(chunk)
+        last_response_id = chunk[-1].response_id
+
+    print(f"port_usage_hourly rebuilt from {rents} rents")
+
+
+if __name__ == '__main__':
+    import asyncio
+    from database.session import engine
+
+    async def main():
+        async with engine.begin() as conn:
+            await backfill_usage_rollup(conn)
+
+    asyncio.run(main())
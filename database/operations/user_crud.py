@@ -3,18 +3,18 @@ from sqlalchemy import select, insert
 
 from api.schemas.user import UserCreate
 from database.models import Users as UserDB
+from database.session import write_transaction
 from api.core.security import get_password_hash, verify_password
 
 
 async def create_user(session: AsyncSession, user_data: UserCreate):
     hashed_password = get_password_hash(user_data.password)
-    async with session:
-        await session.execute(insert(UserDB).values(
-            login=user_data.login,
-            password=hashed_password,
-            is_admin=user_data.is_admin
-        ).returning(UserDB.user_id))
-        await session.commit()
+    query = insert(UserDB).values(
+        login=user_data.login,
+        password=hashed_password,
+        is_admin=user_data.is_admin
+    )
+    await write_transaction(lambda session: session.execute(query), session)
 
 
 async def check_user_exists(session: AsyncSession, login: str):
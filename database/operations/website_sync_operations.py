@@ -1,33 +1,27 @@
 import asyncio
+import hashlib
+from dataclasses import dataclass, field
+from datetime import datetime
 
-import aiohttp
-from aiohttp import ClientSession
-from sqlalchemy import select, insert, update
+from sqlalchemy import select, insert, update, delete
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from api.utils.ip_requests import get_ip_info, get_http_proxy_ip_multitry
-from database.models import Ports, Sellers, Geos, SyncStatus
-from database.operations.bot_operations import add_port_ip_version, delete_port
-from database.session import SessionLocal
+from database.models import Ports, Sellers, Geos, SyncStatus, SellerSyncs
+from config import PROBE_CONCURRENCY, PROBE_PORT_TIMEOUT, PROBE_WRITE_BATCH
+from database.dimensions import dimensions
+from database.port_index import free_ports
+from database.session import SessionLocal, upsert_insert, write_transaction
 
-from database.operations.api_port_transactions import create_new_ip_info
+from database.operations.api_port_transactions import insert_ip_info
 
 
 async def autosync_on():
-    async with SessionLocal() as session:
-        await session.execute(
-            update(SyncStatus)
-            .values(sync_on=True)
-        )
-        await session.commit()
+    await write_transaction(lambda session: session.execute(update(SyncStatus).values(sync_on=True)))
 
 
 async def autosync_off():
-    async with SessionLocal() as session:
-        await session.execute(
-            update(SyncStatus)
-            .values(sync_on=False)
-        )
-        await session.commit()
+    await write_transaction(lambda session: session.execute(update(SyncStatus).values(sync_on=False)))
 
 
 async def get_sync_status():
@@ -44,6 +38,13 @@ async def get_all_sellers():
         return sellers.scalars().all()
 
 
+async def record_seller_sync(seller_id: int, started_at: datetime, duration: float, summary: str | None,
+                             error: str | None):
+    query = insert(SellerSyncs).values(seller_id=seller_id, started_at=started_at, duration=duration,
+                                       summary=summary, error=error)
+    await write_transaction(lambda session: session.execute(query))
+
+
 async def get_geo_id(geo: str):
     async with SessionLocal() as session:
         query = select(Geos.geo_id).where(Geos.name == geo)
@@ -52,6 +53,7 @@ async def get_geo_id(geo: str):
         if result:
             return result
 
+    async def transaction(session: AsyncSession):
         insert_geo = await session.execute(
             insert(Geos)
             .values(name=geo)
@@ -59,95 +61,190 @@ async def get_geo_id(geo: str):
         )
         return insert_geo.scalar()
 
+    return await write_transaction(transaction)
 
-async def upsert_update_ports(seller_id: int, ports: list[dict]):
-    updated_port_ids = []
-    inserted_port_ids = []
-    inserted_ports = []
 
+@dataclass
+class SyncSummary:
+    added: list[int] = field(default_factory=list)
+    changed: list[int] = field(default_factory=list)
+    removed: list[int] = field(default_factory=list)
+    failed: list[int] = field(default_factory=list)      # Didn't answer the probe and were deleted
+    unchanged: int = 0
 
-    for port in ports:
-        update_returned = await update_port(seller_id, port)
-        if update_returned:
-            updated_port_ids.append(update_returned)
-        else:
-            inserted_port = await insert_port(seller_id, port)
-            inserted_ports.append(inserted_port)
+    @property
+    def touched_port_ids(self) -> list[int]:
+        return self.added + self.changed + self.removed + self.failed
 
-    if inserted_ports:
-        tasks = []
+    def __str__(self):
+        # Failed ports include ones left unprobed by an earlier sync, those were never counted as added
+        added = len(set(self.added) - set(self.failed))
+        return (f"added {added}, changed {len(self.changed)}, "
+                f"removed {len(self.removed)}, failed {len(self.failed)}, unchanged {self.unchanged}")
 
-        connector = aiohttp.TCPConnector(limit=95)
-        http_session = ClientSession(connector=connector)
-        for inserted_port in inserted_ports:
-            tasks.append(get_and_save_ip_info(inserted_port, http_session))
 
+def port_fingerprint(port: dict) -> str:
+    return hashlib.sha1(repr(sorted((key, str(value)) for key, value in port.items())).encode()).hexdigest()
 
-        for task in asyncio.as_completed(tasks, timeout=80):        # Timeout is higher than the one in get_http_proxy_ip so no exception catching
-            port_id, is_inserted = await task
-            print(port_id, is_inserted)
-            if is_inserted:
-                inserted_port_ids.append(port_id)
 
-        # results = await asyncio.gather(*tasks)
-        # for result in results:
-        #     if result[1]:
-        #         inserted_port_id = result[0]
-        #         inserted_port_ids.append(inserted_port_id)
+async def upsert_update_ports(seller_id: int, ports: list[dict]) -> SyncSummary:
+    """
+    Apply a seller's scraped port list. Only new, changed and removed ports are written, all in one transaction.
+    New ports are probed afterwards and deleted if they don't answer.
+    """
+    summary, inserted_ports = await sync_seller_ports(seller_id, ports)
 
-        await http_session.close()
+    if inserted_ports:
+        summary.failed = await probe_new_ports(inserted_ports)
 
-    return updated_port_ids + inserted_port_ids
+    return summary
 
 
-async def update_port(seller_id: int, port: dict):
-    async with SessionLocal() as session:
-        update_query = await session.execute(
-            update(Ports)
-            .where(Ports.host == port['host'], Ports.socks_port == port['socks_port'],
-                   Ports.http_port == port['http_port'], Ports.seller_id == seller_id)
-            .values(login=port['login'], password=port['password'], rotation_link=port['rotation_link'],
-                    rent_end=port['rent_end'])
-            .returning(Ports.port_id)
-        )
-        returned_id = update_query.scalar()
-        await session.commit()
-        return returned_id
-
-
-async def insert_port(seller_id: int, port: dict):
-    async with SessionLocal() as session:
-        insert_query = await session.execute(
-            insert(Ports)
-            .values(**port, seller_id=seller_id, is_active=True)
-            .returning(Ports)
+async def sync_seller_ports(seller_id: int, ports: list[dict]):
+    # The last record wins if the site lists the same port twice, ON CONFLICT can't touch a row twice
+    rows = {}
+    for port in ports:
+        rows[(port['host'], port['socks_port'], port['http_port'])] = dict(
+            port, seller_id=seller_id, is_active=True, sync_fingerprint=port_fingerprint(port)
         )
 
-        inserted_port = insert_query.scalars().first()
-        await session.commit()
-        return inserted_port
-
-
-async def get_and_save_ip_info(port: Ports, http_session: ClientSession):
-    port_id = port.port_id
-    ip, ip_ver = await get_http_proxy_ip_multitry(http_session, port.host, port.http_port, port.login, port.password)
-    if ip:
-        await add_port_ip_version(port.port_id, ip_ver)
-        ip_info = await get_ip_info(http_session, ip)
-        await create_new_ip_info(port.port_id, ip_info['ip'], ip_ver, ip_info['city'], ip_info['region'],
-                                 ip_info['org'])
-        return port_id, True
-    else:
-        await delete_port(port.port_id)
-        return port_id, False
-
-
-async def deactivate_ports(seller_id: int, port_ids: list):
+    # Step 1: Compare with the Stored Fingerprints (read only, most syncs stop here)
     async with SessionLocal() as session:
-        await session.execute(
-            update(Ports)
-            .where(Ports.seller_id == seller_id, Ports.port_id.in_(port_ids))
-            .values(is_active=False)
+        existing_query = await session.execute(
+            select(Ports.port_id, Ports.host, Ports.socks_port, Ports.http_port, Ports.login, Ports.password,
+                   Ports.is_active, Ports.current_ip_info_id, Ports.sync_fingerprint)
+            .where(Ports.seller_id == seller_id)
         )
-        await session.commit()
-
+        existing = {(port.host, port.socks_port, port.http_port): port for port in existing_query.all()}
+
+    summary = SyncSummary()
+    to_write = []
+    unprobed = []       # Unchanged, but a previous sync stopped before probing them
+    for key, row in rows.items():
+        port = existing.get(key)
+        if port and port.sync_fingerprint == row['sync_fingerprint']:
+            summary.unchanged += 1
+            if port.current_ip_info_id is None and port.is_active:
+                unprobed.append(port)
+        else:
+            to_write.append(row)
+    removed_ids = [port.port_id for key, port in existing.items() if key not in rows and port.is_active]
+
+    if not to_write and not removed_ids:
+        return summary, unprobed
+
+    async def transaction(session: AsyncSession):
+        # Step 2: Insert or Update the New and Changed Ports
+        written = []
+        for start in range(0, len(to_write), 500):
+            stmt = upsert_insert(Ports).values(to_write[start:start + 500])
+            stmt = stmt.on_conflict_do_update(
+                index_elements=['seller_id', 'host', 'socks_port', 'http_port'],
+                set_=dict(login=stmt.excluded.login, password=stmt.excluded.password,
+                          rotation_link=stmt.excluded.rotation_link, rent_end=stmt.excluded.rent_end,
+                          sync_fingerprint=stmt.excluded.sync_fingerprint)
+            ).returning(Ports.port_id, Ports.host, Ports.socks_port, Ports.http_port, Ports.login,
+                        Ports.password)
+            written.extend((await session.execute(stmt)).all())
+
+        # Step 3: Deactivate the Ports that are not listed anymore
+        removed = []
+        if removed_ids:
+            deactivate_query = await session.execute(
+                update(Ports)
+                .where(Ports.port_id.in_(removed_ids))
+                .where(Ports.is_active.is_(True))
+                .values(is_active=False)
+                .returning(Ports.port_id)
+            )
+            removed = deactivate_query.scalars().all()
+
+        return written, removed
+
+    written, summary.removed = await write_transaction(transaction)
+
+    inserted = unprobed
+    for port in written:
+        if (port.host, port.socks_port, port.http_port) in existing:
+            summary.changed.append(port.port_id)
+        else:
+            summary.added.append(port.port_id)
+            inserted.append(port)
+
+    return summary, inserted
+
+
+async def probe_new_ports(ports: list) -> list[int]:
+    """
+    Probe new ports with at most PROBE_CONCURRENCY running at once and save the results in batches as they come in.
+    Ports that don't answer are deleted. Ports whose probe timed out or whose IP info couldn't be fetched are left
+    without IP info, so the next sync tries them again. Returns the deleted port ids.
+    """
+    pending = list(ports)
+    results = asyncio.Queue()
+
+    async def worker():
+        while pending:
+            port = pending.pop()
+            await results.put((port, await _probe_port(port)))
+
+    workers = [asyncio.create_task(worker()) for _ in range(min(PROBE_CONCURRENCY, len(ports)))]
+
+    dead_port_ids = []
+    try:
+        received = 0
+        while received < len(ports):
+            # Whatever finished while the previous batch was written goes into the next one
+            batch = [await results.get()]
+            while not results.empty() and len(batch) < PROBE_WRITE_BATCH:
+                batch.append(results.get_nowait())
+            received += len(batch)
+
+            dead_port_ids += await save_probe_results(batch)
+    finally:
+        for task in workers:
+            task.cancel()
+
+    return dead_port_ids
+
+
+async def _probe_port(port):
+    """Returns (ip_version, ip_info), False for a dead proxy and None if the result is unknown."""
+    try:
+        async with asyncio.timeout(PROBE_PORT_TIMEOUT):
+            ip, ip_ver = await get_http_proxy_ip_multitry(port.host, port.http_port, port.login, port.password)
+            if not ip:
+                return False
+
+            ip_info = await get_ip_info(ip)
+            return (ip_ver, ip_info) if ip_info else None
+    except Exception as e:
+        print(f"Probe of port {port.port_id} failed: {e!r}")
+        return None
+
+
+async def save_probe_results(batch: list) -> list[int]:
+    found = [(port, result) for port, result in batch if result]
+    dead_port_ids = [port.port_id for port, result in batch if result is False]
+
+    async def transaction(session: AsyncSession):
+        ids = []
+        for port, (ip_ver, ip_info) in found:
+            await session.execute(update(Ports).where(Ports.port_id == port.port_id).values(ip_version=ip_ver))
+            ids.append(await insert_ip_info(session, port.port_id, ip_info['ip'], ip_ver, ip_info['city'],
+                                            ip_info['region'], ip_info['org']))
+
+        if dead_port_ids:
+            await session.execute(delete(Ports).where(Ports.port_id.in_(dead_port_ids)))
+        return ids
+
+    ids = await write_transaction(transaction)
+
+    for (port, (_, ip_info)), (operator_id, city_id) in zip(found, ids):
+        dimensions.operators[ip_info['org']] = operator_id
+        dimensions.cities[(ip_info['city'], ip_info['region'])] = city_id
+    for port_id in dead_port_ids:
+        free_ports.remove(port_id)
+    await free_ports.refresh([port.port_id for port, _ in found])
+
+    return dead_port_ids
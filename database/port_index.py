@@ -0,0 +1,111 @@
+from collections import OrderedDict
+
+from sqlalchemy import select, exists
+
+from database.models import Ports, Geos, PortResponses
+from database.session import SessionLocal
+
+
+class FreePortIndex:
+    """
+    In-process index of free ports keyed by (geo, ip_version).
+
+    The database stays the source of truth: the index only tells the allocator which port to try first,
+    the claim itself is still checked and written inside the allocation transaction.
+    """
+
+    def __init__(self):
+        self._free: dict[str, dict[int | None, OrderedDict]] = {}
+        self._port_keys: dict[int, tuple[str, int | None]] = {}
+        self._listeners = []
+
+    def add_listener(self, callback):
+        """Register a callback that is called every time ports are returned to the pool."""
+        self._listeners.append(callback)
+
+    def _notify(self):
+        for callback in self._listeners:
+            callback()
+
+    async def rebuild(self):
+        async with SessionLocal() as session:
+            result = await session.execute(self._ports_query())
+            rows = result.all()
+
+        self._free = {}
+        self._port_keys = {}
+        for port_id, geo, ip_version, is_busy in rows:
+            self._port_keys[port_id] = (geo, ip_version)
+            if not is_busy:
+                self._bucket(geo, ip_version)[port_id] = None
+        self._notify()
+
+    async def refresh(self, port_ids: list[int]):
+        """Re-read the given ports from the database, e.g. after sync or a manual change."""
+        if not port_ids:
+            return
+
+        async with SessionLocal() as session:
+            result = await session.execute(self._ports_query().where(Ports.port_id.in_(port_ids)))
+            rows = result.all()
+
+        for port_id in port_ids:
+            self.remove(port_id)
+
+        for port_id, geo, ip_version, is_busy in rows:
+            self._port_keys[port_id] = (geo, ip_version)
+            if not is_busy:
+                self._bucket(geo, ip_version)[port_id] = None
+        self._notify()
+
+    def claim(self, geo: str, ip_version: int) -> int | None:
+        """Pop a free port for the request, ip_version 0 means any version."""
+        buckets = self._free.get(geo)
+        if not buckets:
+            return None
+
+        if ip_version != 0:
+            bucket = buckets.get(ip_version)
+            if bucket:
+                return bucket.popitem(last=False)[0]
+            return None
+
+        for bucket in buckets.values():
+            if bucket:
+                return bucket.popitem(last=False)[0]
+        return None
+
+    def release(self, port_id: int):
+        """Put a known port back to the free pool, unknown (inactive/deleted) ports are ignored."""
+        key = self._port_keys.get(port_id)
+        if key:
+            self._bucket(*key)[port_id] = None
+            self._notify()
+
+    def remove(self, port_id: int):
+        key = self._port_keys.pop(port_id, None)
+        if key:
+            self._bucket(*key).pop(port_id, None)
+
+    def free_count(self, geo: str, ip_version: int = 0) -> int:
+        buckets = self._free.get(geo, {})
+        if ip_version != 0:
+            return len(buckets.get(ip_version, ()))
+        return sum(len(bucket) for bucket in buckets.values())
+
+    def _bucket(self, geo: str, ip_version: int | None) -> OrderedDict:
+        return self._free.setdefault(geo, {}).setdefault(ip_version, OrderedDict())
+
+    @staticmethod
+    def _ports_query():
+        is_busy = exists().where(PortResponses.port_id == Ports.port_id)
+
+        return (
+            select(Ports.port_id, Geos.name, Ports.ip_version, is_busy)
+            .join(Geos)
+            .where(Ports.is_active.is_(True))
+            .where(Ports.current_ip_info_id.isnot(None))
+        )
+
+
+free_ports = FreePortIndex()
@@ -1,10 +1,51 @@
+import asyncio
+
+from sqlalchemy import event
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
 
+from config import (DATABASE_URL, DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_RECYCLE, SQLITE_BUSY_TIMEOUT,
+                    SQLITE_WRITE_BATCH)
+
+
+def _sqlite_engine(immediate: bool = False, **kwargs):
+    sqlite_engine = create_async_engine(DATABASE_URL, echo=False, connect_args={'timeout': SQLITE_BUSY_TIMEOUT}, **kwargs)
+
+    @event.listens_for(sqlite_engine.sync_engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute(f'PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT * 1000}')
+        cursor.close()
+        if immediate:
+            # Let SQLAlchemy emit BEGIN itself, so savepoints work and the write lock is taken upfront
+            dbapi_connection.isolation_level = None
+
+    if immediate:
+        @event.listens_for(sqlite_engine.sync_engine, 'begin')
+        def on_begin(conn):
+            conn.exec_driver_sql('BEGIN IMMEDIATE')
+
+    return sqlite_engine
 
-# TODO Change to postgres after local testing
-DATABASE_URL = r"sqlite+aiosqlite:///D:\fun_project\proxyManager\proxy.sqlite"
 
-engine = create_async_engine(DATABASE_URL, echo=False)
+if DATABASE_URL.startswith('sqlite'):
+    # WAL lets reads run in parallel with the writer, all writes go through a single connection (see SQLiteWriter)
+    engine = _sqlite_engine()
+    write_engine = _sqlite_engine(immediate=True, pool_size=1, max_overflow=0)
+else:
+    engine = create_async_engine(
+        DATABASE_URL,
+        echo=False,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=True,
+    )
+    write_engine = None
+
 SessionLocal = async_sessionmaker(autocommit=False, autoflush=False, bind=engine, class_=AsyncSession, expire_on_commit=False)
 
 
@@ -16,3 +57,85 @@ async def get_db():
         await db.close()
 
 
+def upsert_insert(table):
+    """INSERT with .on_conflict_do_update() / .on_conflict_do_nothing() for the configured database."""
+    if engine.dialect.name == 'postgresql':
+        return postgresql.insert(table)
+    return sqlite.insert(table)
+
+
+class SQLiteWriter:
+    """
+    Single writer task for SQLite. Queued write transactions are run one after another on one connection,
+    each inside its own savepoint, and committed together (group commit).
+    """
+
+    def __init__(self, session_maker: async_sessionmaker):
+        self._session_maker = session_maker
+        self._queue = None
+        self._task = None
+
+    async def run(self, work):
+        if self._task is None or self._task.done():
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._serve())
+
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((work, future))
+        return await future
+
+    async def _serve(self):
+        while True:
+            batch = [await self._queue.get()]
+            while not self._queue.empty() and len(batch) < SQLITE_WRITE_BATCH:
+                batch.append(self._queue.get_nowait())
+
+            results = []
+            try:
+                async with self._session_maker() as session:
+                    async with session.begin():
+                        for work, future in batch:
+                            try:
+                                async with session.begin_nested():
+                                    results.append((future, await work(session), None))
+                            except Exception as e:
+                                results.append((future, None, e))
+            except Exception as e:
+                # The commit failed, nothing from this batch was written
+                results = [(future, None, e) for _, future in batch]
+
+            for future, result, error in results:
+                if future.done():
+                    continue
+                if error:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
+
+
+sqlite_writer = SQLiteWriter(async_sessionmaker(bind=write_engine, class_=AsyncSession, expire_on_commit=False)) \
+    if write_engine else None
+
+
+async def write_transaction(work, session: AsyncSession = None):
+    """
+    Run `await work(session)` inside a write transaction and return its result.
+    On SQLite the work is queued to the single writer, otherwise it runs in its own transaction on `session`
+    (or on a new session if none is given).
+    """
+    if sqlite_writer:
+        return await sqlite_writer.run(work)
+
+    if session is not None:
+        if session.in_transaction():
+            # The session was already used for reads, finish that transaction together with the work
+            result = await work(session)
+            await session.commit()
+            return result
+
+        async with session.begin():
+            return await work(session)
+
+    async with SessionLocal() as session:
+        async with session.begin():
+            return await work(session)
@@ -0,0 +1,96 @@
+import asyncio
+import heapq
+from dataclasses import dataclass
+from datetime import datetime
+
+from sqlalchemy import select
+
+from database.enums import RequestStatus
+from database.models import Requests
+from database.port_index import free_ports
+from database.session import SessionLocal
+
+
+@dataclass
+class Waiter:
+    request_id: int
+    geo: str
+    ip_version: int
+    priority: int
+    created_at: datetime
+
+
+class WaitingQueue:
+    """
+    Requests in WAITING_FOR_PORT status, one heap per (geo, ip_version).
+    Higher priority goes first, requests with the same priority are served oldest first.
+    """
+
+    def __init__(self):
+        self._waiters: dict[tuple[str, int], list] = {}
+        self._wakeup = asyncio.Event()
+        self._watched: dict[int, asyncio.Event] = {}
+
+    async def rebuild(self):
+        async with SessionLocal() as session:
+            result = await session.execute(
+                select(Requests)
+                .where(Requests.status == RequestStatus.WAITING_FOR_PORT)       # type: ignore
+            )
+            requests = result.scalars().all()
+
+        self._waiters = {}
+        for request in requests:
+            self.push(Waiter(request.request_id, request.geo, request.ip_version, request.priority, request.created_at))
+
+    def push(self, waiter: Waiter):
+        heap = self._waiters.setdefault((waiter.geo, waiter.ip_version), [])
+        heapq.heappush(heap, (-waiter.priority, waiter.created_at, waiter.request_id, waiter))
+        self._wakeup.set()
+
+    def pop_servable(self) -> Waiter | None:
+        """Pop the best waiter among those that have a free port right now."""
+        best = None
+        for key, heap in self._waiters.items():
+            if heap and free_ports.free_count(*key) and (best is None or heap[0] < self._waiters[best][0]):
+                best = key
+
+        if best is None:
+            return None
+        return heapq.heappop(self._waiters[best])[-1]
+
+    def wake(self):
+        self._wakeup.set()
+
+    async def wait(self):
+        await self._wakeup.wait()
+        self._wakeup.clear()
+
+    def watch(self, request_id: int):
+        """Start tracking a long-polled request, must be called before the request can be served."""
+        self._watched.setdefault(request_id, asyncio.Event())
+
+    def mark_served(self, request_id: int):
+        event = self._watched.get(request_id)
+        if event:
+            event.set()
+
+    async def wait_until_served(self, request_id: int, timeout: float) -> bool:
+        event = self._watched.get(request_id)
+        if not event:
+            return False
+
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self._watched.pop(request_id, None)
+
+    def __len__(self):
+        return sum(len(heap) for heap in self._waiters.values())
+
+
+waiting_queue = WaitingQueue()
+free_ports.add_listener(waiting_queue.wake)
@@ -0,0 +1,51 @@
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+
+import pytest
+
+# config.py reads these on import, tests that need a database create their own
+os.environ.setdefault('BOT_ADMINS', '0')
+os.environ.setdefault('DATABASE_URL', f'sqlite+aiosqlite:///{tempfile.mkdtemp()}/proxy.sqlite')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def _free_tcp_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture(scope='session')
+def postgres_url(tmp_path_factory):
+    """
+    URL of a Postgres server for the tests: TEST_POSTGRES_URL if it is set, otherwise a throwaway cluster
+    started with initdb and pg_ctl from PG_BIN or PATH. Tests using it are skipped when neither is available.
+    """
+    pytest.importorskip('asyncpg')
+
+    url = os.getenv('TEST_POSTGRES_URL')
+    if url:
+        yield url
+        return
+
+    initdb = shutil.which('initdb', path=os.getenv('PG_BIN'))
+    pg_ctl = shutil.which('pg_ctl', path=os.getenv('PG_BIN'))
+    if not initdb or not pg_ctl:
+        pytest.skip('No Postgres found, set TEST_POSTGRES_URL or put initdb and pg_ctl on PATH')
+    if os.geteuid() == 0:
+        pytest.skip('Postgres refuses to run as root, set TEST_POSTGRES_URL')
+
+    data_dir = tmp_path_factory.mktemp('postgres')
+    port = _free_tcp_port()
+    subprocess.run([initdb, '-D', data_dir, '-U', 'postgres', '--auth=trust'], check=True, capture_output=True)
+    subprocess.run([pg_ctl, '-D', data_dir, '-l', data_dir / 'postgres.log', '-w', 'start',
+                    '-o', f'-p {port} -k {data_dir} -c listen_addresses=127.0.0.1'], check=True, capture_output=True)
+    try:
+        yield f'postgresql+asyncpg://postgres@127.0.0.1:{port}/postgres'
+    finally:
+        subprocess.run([pg_ctl, '-D', data_dir, '-m', 'immediate', 'stop'], capture_output=True)
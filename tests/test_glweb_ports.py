@@ -0,0 +1,99 @@
+import asyncio
+from datetime import datetime
+from pathlib import Path
+
+import pytest
+from aiohttp import web
+
+from api.utils import glweb_ports
+from api.utils.glweb_ports import parse_login_form, parse_ports
+from api.utils.http_client import http_clients
+
+FIXTURES = Path(__file__).parent / 'fixtures' / 'glweb'
+
+
+def test_parse_login_form():
+    action, form_data = parse_login_form((FIXTURES / 'login.html').read_text(encoding='utf-8'), 'seller', 'secret')
+
+    assert action == '/login/check/'
+    assert form_data == {
+        'csrf_token': '4f1c2a9e7b3d4e0f8a6c5b2d1e9f7a3c',
+        'username': 'seller',
+        'password': 'secret',
+    }
+
+
+def test_parse_login_form_without_form():
+    with pytest.raises(RuntimeError):
+        parse_login_form((FIXTURES / 'proxies.html').read_text(encoding='utf-8'), 'seller', 'secret')
+
+
+def test_parse_ports():
+    ports = parse_ports((FIXTURES / 'proxies.html').read_text(encoding='utf-8'))
+
+    assert ports == [
+        {
+            'host': '91.200.12.34',
+            'http_port': 20001,
+            'socks_port': 10001,
+            'login': 'user1',
+            'password': 'pass1',
+            'rotation_link': 'https://glweb.studio/api/changeip/?key=a1b2c3',
+            'rent_end': datetime(2026, 3, 5, 14, 30),
+        },
+        {
+            'host': '91.200.12.35',
+            'http_port': 20002,
+            'socks_port': 10002,
+            'login': 'user2',
+            'password': 'pass2',
+            'rotation_link': 'https://glweb.studio/api/changeip/?key=d4e5f6',
+            'rent_end': datetime(2025, 12, 31, 9, 5),
+        },
+    ]
+
+
+async def _extract_from_local_site(monkeypatch, accept_password: str):
+    posted = {}
+
+    async def login_page(request):
+        return web.Response(text=(FIXTURES / 'login.html').read_text(encoding='utf-8'), content_type='text/html')
+
+    async def login_check(request):
+        posted.update(await request.post())
+        if posted.get('password') != accept_password:
+            raise web.HTTPFound('/login/')
+        raise web.HTTPFound('/proxies/')
+
+    async def proxies_page(request):
+        return web.Response(text=(FIXTURES / 'proxies.html').read_text(encoding='utf-8'), content_type='text/html')
+
+    app = web.Application()
+    app.router.add_get('/login/', login_page)
+    app.router.add_post('/login/check/', login_check)
+    app.router.add_get('/proxies/', proxies_page)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', 0).start()
+    port = runner.addresses[0][1]
+    monkeypatch.setattr(glweb_ports, 'GLWEB_LOGIN_URL', f'http://127.0.0.1:{port}/login/')
+
+    try:
+        return await glweb_ports.extract_ports('seller', 'secret'), posted
+    finally:
+        await http_clients.close()
+        await runner.cleanup()
+
+
+def test_extract_ports_logs_in_and_parses_the_proxy_list(monkeypatch):
+    ports, posted = asyncio.run(_extract_from_local_site(monkeypatch, accept_password='secret'))
+
+    assert posted['username'] == 'seller'
+    assert posted['csrf_token'] == '4f1c2a9e7b3d4e0f8a6c5b2d1e9f7a3c'
+    assert [port['socks_port'] for port in ports] == [10001, 10002]
+
+
+def test_extract_ports_rejected_login(monkeypatch):
+    with pytest.raises(RuntimeError, match='login failed'):
+        asyncio.run(_extract_from_local_site(monkeypatch, accept_password='other'))
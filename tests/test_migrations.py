@@ -0,0 +1,124 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+from sqlalchemy import select, insert, exists, text
+from sqlalchemy.dialects import sqlite
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import StaticPool
+
+from database.enums import RequestStatus, ResponseStatus
+from database.migrations import MIGRATIONS
+from database.models import Base, Sellers, Ports, IPInfo, Requests, Responses, PortResponses
+
+
+async def create_unindexed_schema(conn):
+    """Tables as they were before the migrations, with none of the indexes."""
+    await conn.run_sync(Base.metadata.create_all)
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            await conn.execute(text(f'DROP INDEX {index.name}'))
+
+
+async def _migrate_duplicates():
+    engine = create_async_engine('sqlite+aiosqlite://', poolclass=StaticPool)
+    async with engine.begin() as conn:
+        await create_unindexed_schema(conn)
+
+        # The same port synced three times, two of the copies rented at once
+        await conn.execute(insert(Sellers).values(seller_id=1))
+        await conn.execute(insert(Ports), [dict(port_id=port_id, seller_id=1, host='host', socks_port=1000,
+                                                http_port=2000, is_active=True) for port_id in (1, 2, 3)])
+        await conn.execute(insert(IPInfo).values(ip_info_id=1, port_id=2, ip='1.1.1.1'))
+        for rent_id, port_id in [(1, 1), (2, 2)]:
+            await conn.execute(insert(Requests).values(request_id=rent_id, status=RequestStatus.SUCCESS))
+            await conn.execute(insert(Responses).values(response_id=rent_id, parent_request_id=rent_id,
+                                                        status=ResponseStatus.SUCCESS))
+            await conn.execute(insert(PortResponses).values(response_id=rent_id, port_id=port_id,
+                                                            end_timestamp_utc=datetime(2030, 1, 1)))
+
+        for _, _, migration in MIGRATIONS:
+            await migration(conn)
+
+        result = dict(
+            ports=(await conn.execute(select(Ports.port_id, Ports.current_ip_info_id))).all(),
+            ip_info_ports=(await conn.execute(select(IPInfo.port_id))).scalars().all(),
+            rents=(await conn.execute(select(PortResponses.response_id, PortResponses.port_id))).all(),
+            responses=(await conn.execute(select(Responses.response_id, Responses.status)
+                                          .order_by(Responses.response_id))).all(),
+        )
+    await engine.dispose()
+    return result
+
+
+def test_hot_path_indexes_merge_duplicates():
+    result = asyncio.run(_migrate_duplicates())
+
+    # The IP Info and its current pointer both move from the deleted copy
+    assert result['ports'] == [(1, 1)]
+    assert result['ip_info_ports'] == [1]
+    assert result['rents'] == [(2, 1)]
+    assert result['responses'] == [(1, ResponseStatus.AUTO_FINISHED), (2, ResponseStatus.SUCCESS)]
+
+
+# Hot queries of the allocation, expiry, sync and statistics paths and the index each of them has to use
+HOT_QUERIES = {
+    'ix_requests_pending': (
+        select(Requests.request_id, Requests.servername, Requests.status)
+        .where(Requests.login == 'client')
+        .where(Requests.geo == 'ua')
+        .where(Requests.ip_version == 4)
+        .where(Requests.status.in_([RequestStatus.WAITING_FOR_PORT, RequestStatus.PORT_WAITING]))
+    ),
+    'ix_requests_status': select(Requests).where(Requests.status == RequestStatus.WAITING_FOR_PORT),
+    'ix_requests_created_at': (
+        select(Requests.status, Requests.geo, Requests.login)
+        .where(Requests.created_at >= datetime(2026, 1, 1))
+        .where(Requests.created_at < datetime(2026, 2, 1))
+    ),
+    'ix_responses_parent_request_id': select(Responses).where(Responses.parent_request_id == 1),
+    'uq_port_responses_port_id': select(exists().where(PortResponses.port_id == 1)),
+    'ix_port_responses_response_id': select(PortResponses).where(PortResponses.response_id == 1),
+    'ix_port_responses_end_timestamp_utc': (
+        select(PortResponses.response_id).where(PortResponses.end_timestamp_utc < datetime(2026, 1, 1))
+    ),
+    'ix_ip_info_port_id_created_at': (
+        select(IPInfo.ip_info_id).where(IPInfo.port_id == 1).order_by(IPInfo.created_at.desc()).limit(1)
+    ),
+    'uq_ports_natural_key': (
+        select(Ports.port_id)
+        .where(Ports.seller_id == 1)
+        .where(Ports.host == 'host')
+        .where(Ports.socks_port == 1000)
+        .where(Ports.http_port == 2000)
+    ),
+    'ix_ports_free_pool': (
+        select(Ports.port_id).where(Ports.is_active.is_(True)).where(Ports.geo_id == 1).where(Ports.ip_version == 4)
+    ),
+}
+
+
+async def _query_plans() -> dict[str, str]:
+    engine = create_async_engine('sqlite+aiosqlite://', poolclass=StaticPool)
+    async with engine.begin() as conn:
+        await create_unindexed_schema(conn)
+        for _, _, migration in MIGRATIONS:
+            await migration(conn)
+
+        plans = {}
+        for index_name, query in HOT_QUERIES.items():
+            sql = query.compile(dialect=sqlite.dialect(), compile_kwargs={'literal_binds': True})
+            rows = (await conn.execute(text(f'EXPLAIN QUERY PLAN {sql}'))).all()
+            plans[index_name] = '\n'.join(row[-1] for row in rows)
+    await engine.dispose()
+    return plans
+
+
+@pytest.fixture(scope='module')
+def query_plans():
+    return asyncio.run(_query_plans())
+
+
+@pytest.mark.parametrize('index_name', list(HOT_QUERIES))
+def test_hot_query_uses_index(query_plans, index_name):
+    assert f'INDEX {index_name}' in query_plans[index_name], query_plans[index_name]
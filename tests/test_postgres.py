@@ -0,0 +1,197 @@
+import asyncio
+import sys
+
+import pytest
+from sqlalchemy import select, insert, func, text
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from sqlalchemy.pool import NullPool
+
+from api.schemas.port import PortRequest, PortsRequest
+from database.dimensions import dimensions
+from database.enums import RequestStatus
+from database.migrations import migrate
+from database.models import Sellers, Ports, Requests, Responses, PortResponses
+from database.operations.api_port_transactions import _lock_free_ports, request_port, request_ports, \
+    create_new_ip_info
+from database.operations.website_sync_operations import get_geo_id, sync_seller_ports
+from database.port_index import free_ports
+from database.waiting_queue import waiting_queue
+
+
+@pytest.fixture
+def postgres(postgres_url, monkeypatch):
+    """Points the database layer at an empty, migrated Postgres database and returns its session maker."""
+    # NullPool: every test runs in its own event loop, pooled asyncpg connections can't move between loops
+    engine = create_async_engine(postgres_url, poolclass=NullPool)
+    session_maker = async_sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+
+    for name, module in list(sys.modules.items()):
+        if name != 'database' and not name.startswith('database.'):
+            continue
+        for attribute, value in [('engine', engine), ('SessionLocal', session_maker),
+                                 ('write_engine', None), ('sqlite_writer', None)]:
+            if hasattr(module, attribute):
+                monkeypatch.setattr(module, attribute, value)
+
+    async def reset():
+        async with engine.begin() as conn:
+            await conn.execute(text('DROP SCHEMA public CASCADE'))
+            await conn.execute(text('CREATE SCHEMA public'))
+        await migrate()
+        await dimensions.rebuild()
+        await free_ports.rebuild()
+
+    asyncio.run(reset())
+    return session_maker
+
+
+async def seed_ports(session_maker, count: int, geo: str = 'ua') -> list[int]:
+    geo_id = await get_geo_id(geo)
+    async with session_maker() as session:
+        async with session.begin():
+            seller_id = (await session.execute(insert(Sellers).values(mark='test').returning(Sellers.seller_id))).scalar()
+            port_ids = (await session.execute(
+                insert(Ports).returning(Ports.port_id, sort_by_parameter_order=True),
+                [dict(seller_id=seller_id, geo_id=geo_id, ip_version=4, host='10.0.0.1', socks_port=10000 + number,
+                      http_port=20000 + number, login='login', password='password', is_active=True)
+                 for number in range(count)]
+            )).scalars().all()
+
+    # Goes through the operator and city upserts
+    for number, port_id in enumerate(port_ids):
+        await create_new_ip_info(port_id, f'10.1.0.{number}', 4, 'Kyiv', 'Kyiv', 'Kyivstar')
+
+    await free_ports.rebuild()
+    return port_ids
+
+
+def test_lock_free_ports_skips_locked_ports(postgres):
+    async def run():
+        await seed_ports(postgres, 3)
+
+        async with postgres() as first, postgres() as second:
+            async with first.begin():
+                [(locked_port, _)] = await _lock_free_ports(first, 'ua', 4, 1)
+                # A stale index hands the same port out again, the row lock must make the second claim skip it
+                free_ports.release(locked_port.port_id)
+
+                async with second.begin():
+                    others = await asyncio.wait_for(_lock_free_ports(second, 'ua', 4, 2), 5)
+
+        return locked_port.port_id, [port.port_id for port, _ in others]
+
+    locked_port_id, other_port_ids = asyncio.run(run())
+
+    assert len(other_port_ids) == 2
+    assert locked_port_id not in other_port_ids
+
+
+def test_request_ports_bulk_insert(postgres):
+    request = PortsRequest(servername='scraper', priority=1, geo='ua', ip_version=4, count=3)
+
+    async def run():
+        port_ids = await seed_ports(postgres, 5)
+
+        async with postgres() as session:
+            first = await request_ports(session, request, 3, 'client')
+        async with postgres() as session:
+            second = await request_ports(session, request, 3, 'client')
+
+        async with postgres() as session:
+            rents = (await session.execute(
+                select(Responses.response_id, Responses.parent_request_id, PortResponses.port_id)
+                .join(PortResponses, PortResponses.response_id == Responses.response_id)
+            )).all()
+        return port_ids, first, second, rents
+
+    port_ids, first, second, rents = asyncio.run(run())
+
+    # Partial fulfilment once the pool runs dry
+    assert len(first) == 3
+    assert len(second) == 2
+
+    results = first + second
+    assert sorted(result.port.port_id for result in results) == sorted(port_ids)
+    # RETURNING rows come back in parameter order, so every result is paired with its own rows
+    assert sorted((result.response_id, result.request_id, result.port.port_id) for result in results) == sorted(rents)
+
+
+def test_request_port_burst_records_one_request(postgres):
+    request = PortRequest(servername='server', priority=1, geo='ua', ip_version=4)
+
+    async def request_once():
+        async with postgres() as session:
+            return await request_port(session, request, 'client')
+
+    async def run():
+        # No ports at all, every call ends up waiting for one
+        results = await asyncio.gather(*(request_once() for _ in range(10)))
+        async with postgres() as session:
+            requests = (await session.execute(select(Requests.request_id, Requests.status))).all()
+        return results, requests
+
+    results, requests = asyncio.run(run())
+
+    assert len(requests) == 1
+    assert requests[0].status == RequestStatus.WAITING_FOR_PORT
+    assert {result.request_id for result in results} == {requests[0].request_id}
+
+
+def test_request_port_queues_waiter_after_commit(postgres, monkeypatch):
+    request = PortRequest(servername='server', priority=1, geo='ua', ip_version=4, wait=1)
+    in_transaction = []
+
+    async def run():
+        async with postgres() as session:
+            # The waiting queue is served from other connections, which can't see the request before the commit
+            def record(*_):
+                in_transaction.append(session.in_transaction())
+
+            monkeypatch.setattr(waiting_queue, 'watch', record)
+            monkeypatch.setattr(waiting_queue, 'push', record)
+            await request_port(session, request, 'client')
+
+    asyncio.run(run())
+
+    assert in_transaction == [False, False]
+
+
+def test_sync_seller_ports_bulk_upsert(postgres):
+    def scraped(number: int, password: str = 'password'):
+        return dict(host='10.0.0.2', http_port=30000 + number, socks_port=40000 + number, login='login',
+                    password=password, rotation_link=None, rent_end=None)
+
+    async def run():
+        geo_id = await get_geo_id('ua')
+        async with postgres() as session:
+            async with session.begin():
+                seller_id = (await session.execute(
+                    insert(Sellers).values(mark='test').returning(Sellers.seller_id)
+                )).scalar()
+
+        # More than one 500 row chunk
+        ports = [dict(scraped(number), geo_id=geo_id) for number in range(600)]
+        first, _ = await sync_seller_ports(seller_id, ports)
+
+        ports[0] = dict(scraped(0, password='changed'), geo_id=geo_id)
+        del ports[1]
+        second, _ = await sync_seller_ports(seller_id, ports)
+
+        async with postgres() as session:
+            stored = (await session.execute(
+                select(func.count(), func.count().filter(Ports.is_active.is_(True)))
+                .where(Ports.seller_id == seller_id)
+            )).one()
+            password = (await session.execute(
+                select(Ports.password).where(Ports.http_port == 30000)
+            )).scalar()
+        return first, second, stored, password
+
+    first, second, stored, password = asyncio.run(run())
+
+    assert len(first.added) == 600
+    assert len(second.changed) == 1
+    assert len(second.removed) == 1
+    assert second.unchanged == 598
+    assert tuple(stored) == (600, 599)
+    assert password == 'changed'
@@ -0,0 +1,64 @@
+import asyncio
+from datetime import datetime
+from types import SimpleNamespace
+
+from sqlalchemy import select, insert
+
+from api.utils.ip_requests import ProbeResult, ProbeAttempt
+from api.utils import rotation
+from api.utils.rotation import RotationPool
+from database.enums import RequestStatus, ResponseStatus
+from database.migrations import migrate
+from database.models import Requests, Responses, IPInfo, Ports, PortResponses
+from database.operations.api_port_transactions import finish_request_and_response
+from database.session import SessionLocal, write_transaction
+
+
+async def _end_closed_rent():
+    await migrate()
+
+    async def seed(session):
+        await session.execute(insert(Ports).values(port_id=7, host='10.0.0.7', is_active=True))
+        await session.execute(insert(Requests).values(request_id=7, login='client', status=RequestStatus.SUCCESS))
+        await session.execute(insert(IPInfo).values(ip_info_id=7, port_id=7, ip='10.0.0.7'))
+        await session.execute(insert(Responses).values(response_id=7, parent_request_id=7, ip_info_id=7,
+                                                       status=ResponseStatus.SUCCESS))
+        await session.execute(insert(PortResponses).values(port_id=7, response_id=7,
+                                                           end_timestamp_utc=datetime.utcnow()))
+    await write_transaction(seed)
+
+    # The rent was closed, then the process died before the port was released
+    await finish_request_and_response(7)
+    await RotationPool(1, 1, 1).end_rent(7, auto=True)
+
+    async with SessionLocal() as session:
+        return (await session.execute(select(PortResponses))).all()
+
+
+def test_end_rent_releases_port_of_already_closed_rent():
+    assert asyncio.run(_end_closed_rent()) == []
+
+
+def test_rotation_records_probe_attempts(monkeypatch):
+    async def probe(*_):
+        return ProbeResult('10.0.0.8', 4, [ProbeAttempt(1, 5.0, False, cancelled=True), ProbeAttempt(2, 0.5, True)])
+
+    async def ip_info(ip):
+        return dict(ip=ip, city='Kyiv', region='Kyiv', org='Kyivstar')
+
+    async def noop(*_):
+        return None
+
+    monkeypatch.setattr(rotation, 'rotate_proxy', noop)
+    monkeypatch.setattr(rotation, 'probe_http_proxy_ip', probe)
+    monkeypatch.setattr(rotation, 'get_ip_info', ip_info)
+    monkeypatch.setattr(rotation, 'create_new_ip_info', noop)
+
+    pool = RotationPool(1, 1, 1)
+    port = SimpleNamespace(port_id=8, seller_id=1, host='10.0.0.8', http_port=8000, login='login', password='password',
+                           rotation_link='http://10.0.0.8/rotate')
+    asyncio.run(pool._rotate(port))
+
+    stages = pool.stats()['stages']
+    assert (stages['probe_attempt']['count'], stages['probe_attempt']['max']) == (1, 0.5)
+    assert (stages['probe_cancelled']['count'], stages['probe_cancelled']['max']) == (1, 5.0)
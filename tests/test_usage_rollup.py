@@ -0,0 +1,57 @@
+import asyncio
+from datetime import datetime
+
+from sqlalchemy import select, insert
+
+from database.enums import RequestStatus, ResponseStatus
+from database.migrations import migrate
+from database.models import Requests, Responses, IPInfo, PortUsageHourly
+from database.operations.api_port_transactions import finish_request_and_response
+from database.operations.usage_rollup import rollup_rows, backfill_usage_rollup
+from database.session import SessionLocal, engine, write_transaction
+
+
+def test_rollup_rows_split_rents_by_hour():
+    rows = rollup_rows([
+        (1, 'client', datetime(2026, 1, 1, 9, 30), datetime(2026, 1, 1, 11, 0)),
+        (1, 'client', datetime(2026, 1, 1, 10, 50), datetime(2026, 1, 1, 10, 55)),
+    ])
+
+    assert sorted((row['hour'].hour, row['busy_seconds'], row['rentals']) for row in rows) == [
+        (9, 1800, 1), (10, 3900, 1),
+    ]
+
+
+async def _finish_twice():
+    await migrate()
+
+    async def seed(session):
+        await session.execute(insert(Requests).values(request_id=1, login='client', status=RequestStatus.SUCCESS))
+        await session.execute(insert(IPInfo).values(ip_info_id=1, port_id=1, ip='10.0.0.1'))
+        await session.execute(insert(Responses).values(response_id=1, parent_request_id=1, ip_info_id=1,
+                                                       status=ResponseStatus.SUCCESS))
+    await write_transaction(seed)
+
+    # /endport and the rent deadline racing each other
+    finished = await asyncio.gather(finish_request_and_response(1), finish_request_and_response(1, auto=True))
+
+    # Other tests share the database file
+    query = (select(PortUsageHourly.port_id, PortUsageHourly.login, PortUsageHourly.rentals)
+             .where(PortUsageHourly.port_id == 1))
+    async with SessionLocal() as session:
+        incremental = (await session.execute(query)).all()
+
+    async with engine.begin() as conn:
+        await backfill_usage_rollup(conn)
+    async with SessionLocal() as session:
+        backfilled = (await session.execute(query)).all()
+
+    return finished, incremental, backfilled
+
+
+def test_rent_is_added_to_rollup_once():
+    finished, incremental, backfilled = asyncio.run(_finish_twice())
+
+    assert finished == [True, False]
+    assert incremental == [(1, 'client', 1)]
+    assert backfilled == incremental
@@ -0,0 +1,8 @@
+from database.operations.website_sync_operations import SyncSummary
+
+
+def test_summary_counts_reprobed_failures_apart_from_added():
+    # Port 3 was left unprobed by an earlier sync, this one probed it and it didn't answer
+    summary = SyncSummary(added=[1, 2], failed=[2, 3], unchanged=5)
+
+    assert str(summary) == 'added 1, changed 0, removed 0, failed 2, unchanged 5'